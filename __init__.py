@@ -1,13 +1,28 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
 from trytond.pool import Pool
+from . import bom
+from . import ir
+from . import product
 from . import production
+from . import stock
 
 
 def register():
     Pool.register(
         production.Production,
+        production.ProductionMassBalanceLine,
+        production.ProductionMassBalanceCache,
+        production.ProductionMassBalanceDay,
+        production.ProductionMassBalanceRun,
+        production.ProductionMassBalanceRunProduct,
         production.PrintProductionMassBalanceStart,
+        stock.Move,
+        bom.BOM,
+        bom.BOMInput,
+        bom.BOMOutput,
+        product.Uom,
+        ir.Cron,
         module='production_mass_balance_report', type_='model')
     Pool.register(
         production.PrintProductionMassBalance,
@@ -15,3 +30,9 @@ def register():
     Pool.register(
         production.PrintProductionMassBalanceReport,
         module='production_mass_balance_report', type_='report')
+    Pool.register(
+        production.ProductionMassBalanceRunLot,
+        production.ProductionMassBalanceLot,
+        production.ProductionLot,
+        module='production_mass_balance_report', type_='model',
+        depends=['stock_lot'])
@@ -0,0 +1,57 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['BOM', 'BOMInput', 'BOMOutput']
+
+
+class BOM(metaclass=PoolMeta):
+    __name__ = 'production.bom'
+
+    @classmethod
+    def delete(cls, boms):
+        pool = Pool()
+        Production = pool.get('production')
+        # the productions lose their BOM and so their plan consumption
+        Production.queue_mass_balance_boms(boms)
+        super().delete(boms)
+
+
+class BOMLineMixin(object):
+    __slots__ = ()
+
+    @classmethod
+    def create(cls, vlist):
+        records = super().create(vlist)
+        cls._update_mass_balance_lines(records)
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        records = [r for records in args[::2] for r in records]
+        # the lines may be moved to another BOM
+        boms = {r.bom for r in records}
+        super().write(*args)
+        cls._update_mass_balance_lines(records, boms)
+
+    @classmethod
+    def delete(cls, records):
+        boms = {r.bom for r in records}
+        super().delete(records)
+        cls._update_mass_balance_lines([], boms)
+
+    @classmethod
+    def _update_mass_balance_lines(cls, records, boms=None):
+        "Recompute the ledger of the productions of the BOMs of records"
+        pool = Pool()
+        Production = pool.get('production')
+        boms = set(boms or []) | {r.bom for r in records}
+        Production.queue_mass_balance_boms(list(boms))
+
+
+class BOMInput(BOMLineMixin, metaclass=PoolMeta):
+    __name__ = 'production.bom.input'
+
+
+class BOMOutput(BOMLineMixin, metaclass=PoolMeta):
+    __name__ = 'production.bom.output'
@@ -0,0 +1,26 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['Uom']
+
+
+class Uom(metaclass=PoolMeta):
+    __name__ = 'product.uom'
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Production = pool.get('production')
+        super().write(*args)
+        actions = iter(args)
+        uoms = []
+        for records, values in zip(actions, actions):
+            if set(values) & cls._mass_balance_line_fields():
+                uoms.extend(records)
+        Production.queue_mass_balance_uoms(uoms)
+
+    @classmethod
+    def _mass_balance_line_fields(cls):
+        "Fields that change the mass balance ledger lines when written"
+        return {'rate', 'factor', 'rounding', 'digits', 'category'}
@@ -1,136 +1,2424 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
-from datetime import datetime
+import csv
+import hashlib
+import heapq
+import html
+import io
+import json
+import logging
+import multiprocessing
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from collections import OrderedDict
-from trytond.model import fields, ModelView
+from collections.abc import MutableSequence
+from itertools import count, islice
+from sql import Literal, Null, Window, With
+from sql.aggregate import Count, Max, Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import Abs, DateTrunc, RowNumber
+from trytond import backend
+from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.model import fields, Index, Model, ModelSQL, ModelView
 from trytond.pool import Pool, PoolMeta
+from trytond.protocols.jsonrpc import JSONDecoder, JSONEncoder
+from trytond.bus import notify
+from trytond.rpc import RPC
+from trytond.i18n import gettext
 from trytond.pyson import Bool, Eval, If
-from trytond.wizard import Wizard, StateView, StateReport, Button
-from trytond.transaction import Transaction
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.wizard import (Wizard, StateView, StateReport, StateTransition,
+    Button)
+from trytond.transaction import Transaction, without_check_access
 from trytond.modules.html_report.dominate_report import DominateReport
 from trytond.modules.html_report.engine import render as html_render
 from trytond.url import http_host
 from trytond.modules.html_report.i18n import _
 from dominate.util import raw
-from dominate.tags import (a, button, div, h1, i, script, strong, table, tbody,
-    td, th, thead, tr)
+from dominate.tags import (a, button, div, h1, pre, script, strong, table,
+    tbody, td, th, thead, tr)
 
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
-__all__ = ['Production', 'PrintProductionMassBalanceStart',
-    'PrintProductionMassBalance', 'PrintProductionMassBalanceReport']
+
+__all__ = ['MassBalanceRow', 'MassBalanceLegacyRow', 'MassBalanceLegacyRows',
+    'MassBalanceRecord',
+    'MassBalanceDeviation', 'Production', 'ProductionMassBalanceLine',
+    'ProductionMassBalanceCache', 'ProductionMassBalanceDay',
+    'ProductionMassBalanceRun',
+    'ProductionMassBalanceRunProduct', 'ProductionMassBalanceRunLot',
+    'ProductionMassBalanceLot', 'ProductionLot',
+    'PrintProductionMassBalanceStart', 'PrintProductionMassBalance',
+    'PrintProductionMassBalanceReport']
+
+logger = logging.getLogger(__name__)
 
 _ZERO = 0.0
+DIRECTIONS = [
+    ('backward', 'Backward'),
+    ('forward', 'Forward'),
+    ]
+TREND_BUCKETS = [
+    (None, ''),
+    ('day', 'Day'),
+    ('week', 'Week'),
+    ('month', 'Month'),
+    ]
+EXPORT_FORMATS = [
+    ('html', 'HTML'),
+    ('csv', 'CSV'),
+    ('xlsx', 'Excel'),
+    ('parquet', 'Parquet'),
+    ]
+
+
+def _init_partition_worker(database_name, options):
+    """
+    Initialize the configuration and the pool of the database in the worker
+    process
+
+    The worker is spawned so it starts from a fresh interpreter: it gets the
+    configuration of the calling process and registers the modules before
+    initializing the pool.
+    """
+    for section, values in options.items():
+        if not config.has_section(section):
+            config.add_section(section)
+        for name, value in values.items():
+            config.set(section, name, value)
+    Pool.start()
+    pool = Pool(database_name)
+    if database_name not in Pool.database_list():
+        with Transaction(new=True).start(database_name, 0, readonly=True):
+            pool.init()
+
+
+def _compute_partition(database_name, user, context, production_ids,
+        requested_product_id, direction, lot_id, engine):
+    "Return the dumped mass balance of the productions in its own transaction"
+    with Transaction(new=True).start(database_name, user, readonly=True,
+            context=context):
+        return _dump_partition(production_ids, requested_product_id,
+            direction, lot_id, engine)
+
+
+def _dump_partition(production_ids, requested_product_id, direction, lot_id,
+        engine):
+    "Return the dumped mass balance of the productions"
+    pool = Pool()
+    Product = pool.get('product.product')
+    Report = pool.get('production.mass_balance.report', type='report')
+    lot = pool.get('stock.lot')(lot_id) if lot_id else None
+    results = Report._prepare_chunks(production_ids,
+        Product(requested_product_id), direction, lot, engine,
+        MassBalanceCache())
+    return dump_records(list(results))
+
+
+@contextmanager
+def writable_transaction():
+    "Yield the transaction, or a new one if it is readonly, to store results"
+    transaction = Transaction()
+    if not transaction.readonly:
+        yield transaction
+    else:
+        with transaction.new_transaction() as new_transaction:
+            yield new_transaction
+            new_transaction.commit()
+
+
+class MassBalanceLedgerManager(object):
+    """
+    Data manager which recomputes the ledger of the productions modified in
+    the transaction once, before it is committed
+    """
+
+    def __init__(self):
+        self.production_ids = set()
+
+    def __eq__(self, other):
+        return isinstance(other, MassBalanceLedgerManager)
+
+    def __hash__(self):
+        return hash(MassBalanceLedgerManager)
+
+    def flush(self):
+        "Recompute the ledger of the pending productions"
+        pool = Pool()
+        Production = pool.get('production')
+        while self.production_ids:
+            production_ids = list(self.production_ids)
+            self.production_ids.clear()
+            Production._update_mass_balance(production_ids)
+
+    def tpc_begin(self, transaction):
+        self.flush()
+
+    def commit(self, transaction):
+        pass
+
+    def tpc_vote(self, transaction):
+        pass
+
+    def tpc_finish(self, transaction):
+        pass
+
+    def tpc_abort(self, transaction):
+        self.production_ids.clear()
+
+
+def dump_records(value):
+    "Return value with its records and dicts converted to JSON values"
+    if isinstance(value, Model):
+        return {'__record__': value.__name__, 'id': value.id}
+    elif isinstance(value, MassBalanceRecord):
+        return {'__mass_balance__': dump_records(value.dump())}
+    elif isinstance(value, dict):
+        return {'__items__': [[dump_records(k), dump_records(v)]
+                for k, v in value.items()]}
+    elif isinstance(value, (list, tuple)):
+        return [dump_records(v) for v in value]
+    return value
+
+
+def load_records(value):
+    "Return the value dumped by dump_records"
+    if isinstance(value, dict):
+        if '__record__' in value:
+            return Pool().get(value['__record__'])(value['id'])
+        elif '__mass_balance__' in value:
+            return MassBalanceRecord.load(
+                load_records(value['__mass_balance__']))
+        elif '__items__' in value:
+            return OrderedDict((load_records(k), load_records(v))
+                for k, v in value['__items__'])
+    elif isinstance(value, list):
+        return [load_records(v) for v in value]
+    return value
+
+
+# keys of the dictionaries formerly used for the mass balance
+_LEGACY_KEYS = {
+    'balance_quantity': 'quantity',
+    'balance_consumption': 'consumption',
+    'balance_plan_consumption': 'plan_consumption',
+    'balance_difference': 'difference',
+    'balance_difference_percent': 'difference_percent',
+    'balance_quantity_uom': 'quantity_uom',
+    'balance_consumption_uom': 'uom',
+    'balance_plan_consumption_uom': 'uom',
+    'balance_difference_uom': 'uom',
+    'productions': 'rows',
+    }
+
+
+class MassBalanceMapping(object):
+    "Dictionary methods over the keys formerly used"
+    __slots__ = ()
+    _mapping_keys = ()
+
+    def keys(self):
+        return list(self._mapping_keys)
+
+    def values(self):
+        return [self[key] for key in self._mapping_keys]
+
+    def items(self):
+        return [(key, self[key]) for key in self._mapping_keys]
+
+    def __iter__(self):
+        return iter(self._mapping_keys)
+
+    def __contains__(self, key):
+        return key in self._mapping_keys
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+
+class MassBalanceRow(object):
+    "Mass balance of a production for a product"
+    __slots__ = ('id', 'name', 'quantity', 'consumption', 'plan_consumption',
+        'difference', 'difference_percent')
+
+    def __init__(self, id, name, quantity=0.0, consumption=0.0,
+            plan_consumption=0.0, difference=0.0, difference_percent=0.0):
+        self.id = id
+        self.name = name
+        self.quantity = quantity
+        self.consumption = consumption
+        self.plan_consumption = plan_consumption
+        self.difference = difference
+        self.difference_percent = difference_percent
+
+    def __getitem__(self, key):
+        return getattr(self, _LEGACY_KEYS.get(key, key))
+
+    def __setitem__(self, key, value):
+        setattr(self, _LEGACY_KEYS.get(key, key), value)
+
+    def get(self, key, default=None):
+        return getattr(self, _LEGACY_KEYS.get(key, key), default)
+
+    def dump(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    @classmethod
+    def from_dict(cls, values):
+        "Return the row of the dictionary formerly used for a production"
+        return cls(values['id'], values['name'],
+            *(values.get(key, 0.0) for key in [
+                    'balance_quantity', 'balance_consumption',
+                    'balance_plan_consumption', 'balance_difference',
+                    'balance_difference_percent']))
+
+
+class MassBalanceLegacyRow(MassBalanceMapping):
+    """
+    Dictionary access to a row with all the keys formerly used
+
+    The product and the unit of the production and the UoMs of the product
+    are not stored in the rows, so they are read from the production and
+    from the record of the row.
+    """
+    __slots__ = ('row', 'record')
+    _mapping_keys = ('id', 'name', 'product', 'uom', 'default_uom',
+        'balance_quantity', 'balance_consumption', 'balance_plan_consumption',
+        'balance_difference', 'balance_difference_percent',
+        'balance_quantity_uom', 'balance_consumption_uom',
+        'balance_plan_consumption_uom', 'balance_difference_uom')
+
+    def __init__(self, row, record):
+        self.row = row
+        self.record = record
+
+    def __getitem__(self, key):
+        if key in {'product', 'uom'}:
+            production = Pool().get('production')(self.row.id)
+            return production.product if key == 'product' else production.unit
+        elif key == 'default_uom' or key.endswith('_uom'):
+            return self.record[key]
+        return self.row[key]
+
+    def __setitem__(self, key, value):
+        self.row[key] = value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except AttributeError:
+            return default
+
+
+def _mass_balance_row(value):
+    "Return the row of value which may be a dictionary formerly used"
+    if isinstance(value, MassBalanceLegacyRow):
+        return value.row
+    elif isinstance(value, dict):
+        return MassBalanceRow.from_dict(value)
+    return value
+
+
+class MassBalanceLegacyRows(MutableSequence):
+    """
+    List of the rows of a record as the dictionaries formerly used
+
+    It reads and writes the rows of the record, so the rows appended are
+    kept by the record.
+    """
+    __slots__ = ('record',)
+
+    def __init__(self, record):
+        self.record = record
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [MassBalanceLegacyRow(row, self.record)
+                for row in self.record.rows[index]]
+        return MassBalanceLegacyRow(self.record.rows[index], self.record)
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = [_mass_balance_row(v) for v in value]
+        else:
+            value = _mass_balance_row(value)
+        self.record.rows[index] = value
+
+    def __delitem__(self, index):
+        del self.record.rows[index]
+
+    def __len__(self):
+        return len(self.record.rows)
+
+    def insert(self, index, value):
+        self.record.rows.insert(index, _mass_balance_row(value))
+
+
+class MassBalanceRecord(MassBalanceMapping):
+    """
+    Mass balance of a product summing the rows of its productions
+
+    The quantity is in quantity_uom and the other values in uom, which are
+    stored once for all the rows.
+    """
+    __slots__ = ('quantity_uom', 'uom', 'quantity', 'consumption',
+        'plan_consumption', 'difference', 'rows', 'default_uom')
+    _mapping_keys = ('balance_quantity', 'balance_consumption',
+        'balance_plan_consumption', 'balance_difference', 'productions',
+        'balance_quantity_uom', 'balance_consumption_uom',
+        'balance_plan_consumption_uom', 'balance_difference_uom')
+
+    def __init__(self, quantity_uom, uom, quantity=0.0, consumption=0.0,
+            plan_consumption=0.0, difference=0.0, rows=None,
+            default_uom=None):
+        self.quantity_uom = quantity_uom
+        self.uom = uom
+        self.quantity = quantity
+        self.consumption = consumption
+        self.plan_consumption = plan_consumption
+        self.difference = difference
+        self.rows = rows if rows is not None else []
+        # the UoM of the product of the record
+        self.default_uom = default_uom
+
+    def __getitem__(self, key):
+        if key == 'productions':
+            return MassBalanceLegacyRows(self)
+        return getattr(self, _LEGACY_KEYS.get(key, key))
+
+    def __setitem__(self, key, value):
+        if key == 'productions':
+            value = [_mass_balance_row(row) for row in value]
+        elif key == 'balance_difference_percent':
+            # computed from the consumptions
+            return
+        setattr(self, _LEGACY_KEYS.get(key, key), value)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except AttributeError:
+            return default
+
+    @property
+    def difference_percent(self):
+        if self.plan_consumption:
+            return ((self.consumption - self.plan_consumption)
+                / self.plan_consumption) * 100
+        return 0.0
+
+    def add(self, row):
+        "Add the row of a production"
+        self.quantity += row.quantity
+        self.consumption += row.consumption
+        self.plan_consumption += row.plan_consumption
+        self.difference += row.difference
+        self.rows.append(row)
+
+    def merge(self, other):
+        "Add the values and the rows of other"
+        self.quantity_uom = other.quantity_uom
+        self.uom = other.uom
+        self.default_uom = other.default_uom
+        self.quantity += other.quantity
+        self.consumption += other.consumption
+        self.plan_consumption += other.plan_consumption
+        self.difference += other.difference
+        self.rows.extend(other.rows)
+
+    def copy(self):
+        return MassBalanceRecord(self.quantity_uom, self.uom, self.quantity,
+            self.consumption, self.plan_consumption, self.difference,
+            self.rows[:], self.default_uom)
+
+    def dump(self):
+        return [self.quantity_uom, self.uom, self.quantity, self.consumption,
+            self.plan_consumption, self.difference,
+            [row.dump() for row in self.rows], self.default_uom]
+
+    @classmethod
+    def load(cls, values):
+        *values, rows, default_uom = values
+        return cls(*values, rows=[MassBalanceRow(*row) for row in rows],
+            default_uom=default_uom)
+
+    @classmethod
+    def from_dict(cls, product, values):
+        """
+        Return the record of the dictionary formerly used for a product
+
+        The values are summed from the productions like the records do.
+        """
+        record = cls(values.get('balance_quantity_uom', product.default_uom),
+            values.get('balance_consumption_uom', product.default_uom),
+            default_uom=product.default_uom)
+        for row in values.get('productions', []):
+            record.add(_mass_balance_row(row))
+        return record
+
+
+class MassBalanceDeviation(object):
+    """
+    Keep only the rows of the productions with the largest deviation
+
+    While the records are merged, the rows of each product are pushed to a
+    heap bounded by limit, so only the limit rows with the largest absolute
+    difference, or difference percentage, beyond the threshold are kept.
+    """
+
+    def __init__(self, limit=None, threshold=None, percentage=False):
+        self.limit = limit
+        self.threshold = threshold
+        self.percentage = percentage
+        self.heaps = {}
+        self.sequence = count()
+
+    @classmethod
+    def from_data(cls, data):
+        "Return the deviation of the report data or None"
+        if not data.get('deviation_limit') and (
+                data.get('deviation_threshold') is None):
+            return None
+        return cls(data.get('deviation_limit'),
+            data.get('deviation_threshold'),
+            bool(data.get('deviation_percentage')))
+
+    def copy(self):
+        "Return an empty deviation with the same criteria"
+        return self.__class__(self.limit, self.threshold, self.percentage)
+
+    def deviation(self, row):
+        return abs(row.difference_percent if self.percentage
+            else row.difference)
+
+    def push(self, product, rows):
+        "Keep the rows of product with the largest deviation"
+        heap = self.heaps.setdefault(product, [])
+        for row in rows:
+            deviation = self.deviation(row)
+            if self.threshold is not None and deviation <= self.threshold:
+                continue
+            # the first rows are kept on ties
+            item = (deviation, -next(self.sequence), row)
+            if not self.limit or len(heap) < self.limit:
+                heapq.heappush(heap, item)
+            elif item[:2] > heap[0][:2]:
+                heapq.heapreplace(heap, item)
+
+    def filter(self, product, record):
+        "Move the rows of the record to the heap of the product"
+        self.push(product, record.rows)
+        record.rows = []
+
+    def finish(self, records):
+        "Set to the records the kept rows by decreasing deviation"
+        for product, record in records.items():
+            heap = self.heaps.pop(product, [])
+            heap.sort(key=lambda item: item[:2], reverse=True)
+            record.rows = [row for _, _, row in heap]
+        return records
+
+
+class CountingCursor(object):
+    "Cursor that counts the queries it executes"
+
+    def __init__(self, cursor, counter):
+        self._cursor = cursor
+        self._counter = counter
+
+    def execute(self, *args, **kwargs):
+        self._counter['queries'] += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class CountingConnection(object):
+    "Connection that returns cursors counting the queries they execute"
+
+    def __init__(self, connection, counter):
+        self._connection = connection
+        self._counter = counter
+
+    def cursor(self, *args, **kwargs):
+        return CountingCursor(
+            self._connection.cursor(*args, **kwargs), self._counter)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+@contextmanager
+def count_queries(counter):
+    "Count in counter the queries executed by the cursors of the block"
+    transaction = Transaction()
+    connection = transaction.connection
+    transaction.connection = CountingConnection(connection, counter)
+    try:
+        yield counter
+    finally:
+        transaction.connection = connection
+
+
+class MassBalanceDiagnostics(object):
+    """
+    Duration, queries and processed items of the phases of a report
+
+    It is enabled by the mass_balance_diagnostics key of the context or the
+    diagnostics option of the production_mass_balance section of the
+    configuration: 'log' sends the phases to the logger and 'report' also
+    adds them to a hidden block of the HTML report.
+    """
+
+    def __init__(self, mode='log'):
+        self.mode = mode
+        self.phases = OrderedDict()
+        self.counts = OrderedDict()
+
+    @classmethod
+    def get_mode(cls):
+        mode = Transaction().context.get('mass_balance_diagnostics')
+        if mode is None:
+            mode = config.get('production_mass_balance', 'diagnostics',
+                default='')
+        if mode is True:
+            mode = 'log'
+        return mode if mode in {'log', 'report'} else None
+
+    @classmethod
+    def current(cls):
+        "Return the diagnostics of the report being executed, if enabled"
+        return Transaction().context.get('_mass_balance_diagnostics')
+
+    @classmethod
+    @contextmanager
+    def measure(cls, name):
+        "Add the duration and queries of the block to the phase name"
+        diagnostics = cls.current()
+        if not diagnostics:
+            yield
+            return
+        phase = diagnostics.phases.setdefault(name, {
+                'calls': 0,
+                'time': 0.0,
+                'queries': 0,
+                })
+        counter = {'queries': 0}
+        start = time.perf_counter()
+        try:
+            with count_queries(counter):
+                yield
+        finally:
+            phase['calls'] += 1
+            phase['time'] += time.perf_counter() - start
+            phase['queries'] += counter['queries']
+
+    @classmethod
+    def count(cls, name, value):
+        "Add value to the number of name processed"
+        diagnostics = cls.current()
+        if diagnostics:
+            diagnostics.counts[name] = diagnostics.counts.get(name, 0) + value
+
+    def lines(self):
+        lines = ['%s: %.3fs, %s queries, %s calls' % (name, phase['time'],
+                phase['queries'], phase['calls'])
+            for name, phase in self.phases.items()]
+        lines.extend('%s: %s' % item for item in self.counts.items())
+        return lines
+
+    def log(self, title):
+        logger.info('%s\n%s', title, '\n'.join(self.lines()))
+
+
+class MassBalanceCache(object):
+    "Values shared by the mass balance computations of a report"
+
+    def __init__(self):
+        self.uom_factors = {}
+        self.bom_inputs = {}
+        self.bom_factors = {}
+
+    def load_uom_factors(self, pairs):
+        "Compute at once the conversion factors of the (from, to) UoM pairs"
+        pool = Pool()
+        Uom = pool.get('product.uom')
+
+        pairs = {(int(f), int(t)) for f, t in pairs
+            if f is not None and t is not None}
+        pairs.difference_update(self.uom_factors)
+        if not pairs:
+            return
+        with MassBalanceDiagnostics.measure('uom'):
+            uoms = Uom.browse(list({u for pair in pairs for u in pair}))
+            uoms = {u.id: u for u in uoms}
+            for from_id, to_id in pairs:
+                if from_id == to_id:
+                    factor = 1.0
+                else:
+                    factor = Uom.compute_qty(uoms[from_id], 1.0,
+                        uoms[to_id], False)
+                self.uom_factors[(from_id, to_id)] = factor
+
+    def uom_factor(self, from_uom, to_uom):
+        key = (int(from_uom), int(to_uom))
+        if key not in self.uom_factors:
+            self.load_uom_factors([key])
+        return self.uom_factors[key]
+
+    def compute_qty(self, from_uom, qty, to_uom):
+        "Convert qty like Uom.compute_qty without rounding"
+        if qty is None or from_uom is None or to_uom is None:
+            return qty
+        return qty * self.uom_factor(from_uom, to_uom)
+
+    def load_boms(self, boms):
+        """
+        Index the input quantities of the BOMs by product
+
+        Each quantity is converted to the default UoM of the product and
+        rounded after each addition like the plan consumption expects.
+        """
+        boms = [b for b in boms if b.id not in self.bom_inputs]
+        if not boms:
+            return
+        with MassBalanceDiagnostics.measure('bom'):
+            self.load_uom_factors((bm.unit, bm.product.default_uom)
+                for bom in boms for bm in bom.inputs)
+            for bom in boms:
+                inputs = self.bom_inputs[bom.id] = {}
+                for bm in bom.inputs:
+                    bqty = inputs.get(bm.product.id, 0.0)
+                    bqty += self.compute_qty(bm.unit, bm.quantity,
+                        bm.product.default_uom)
+                    # To ensure that all is calcaultaed correctly, round
+                    # after UOM convert and add with the possible qty
+                    # existent. It will be the more equl to consumption
+                    # expected related with consumption.
+                    inputs[bm.product.id] = bm.unit.round(bqty)
+
+    def bom_factor(self, bom, product, input_product):
+        "Return the factor of input_product to produce product with the BOM"
+        key = (bom.id, product.id, input_product.id)
+        if key not in self.bom_factors:
+            if bom.id not in self.bom_inputs:
+                self.load_boms([bom])
+            bqty = self.bom_inputs[bom.id].get(input_product.id, 0.0)
+            with MassBalanceDiagnostics.measure('bom'):
+                self.bom_factors[key] = bom.compute_factor(product, bqty,
+                    product.default_uom)
+        return self.bom_factors[key]
+
+
+class Production(metaclass=PoolMeta):
+    __name__ = 'production'
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        actions = iter(args)
+        to_update = []
+        for productions, values in zip(actions, actions):
+            if set(values) & cls._mass_balance_line_fields():
+                to_update.extend(productions)
+        cls.queue_mass_balance_lines(to_update)
+
+    @classmethod
+    def _mass_balance_line_fields(cls):
+        "Fields that change the mass balance ledger lines when written"
+        return {'state', 'company', 'product', 'bom', 'quantity', 'unit'}
+
+    @classmethod
+    def mass_balance_maintained(cls):
+        "Return if the mass balance ledger is maintained"
+        Line = Pool().get('production.mass_balance.line')
+        return Line.enabled()
+
+    @classmethod
+    def queue_mass_balance_lines(cls, productions):
+        """
+        Recompute the mass balance ledger of the productions once, when the
+        transaction is committed or the ledger is read
+        """
+        if productions and cls.mass_balance_maintained():
+            manager = Transaction().join(MassBalanceLedgerManager())
+            manager.production_ids.update(
+                p.id if isinstance(p, Model) else p for p in productions)
+
+    @classmethod
+    def flush_mass_balance_lines(cls):
+        "Recompute the mass balance ledger of the productions queued"
+        if cls.mass_balance_maintained():
+            Transaction().join(MassBalanceLedgerManager()).flush()
+
+    @classmethod
+    def queue_mass_balance_boms(cls, boms):
+        "Recompute the mass balance ledger of the productions of the BOMs"
+        if boms and cls.mass_balance_maintained():
+            cls.queue_mass_balance_lines(cls.search([
+                        ('bom', 'in', [b.id for b in boms]),
+                        ('state', 'in', ['running', 'done', 'cancelled']),
+                        ]))
+
+    @classmethod
+    def queue_mass_balance_uoms(cls, uoms):
+        """
+        Recompute the mass balance ledger of the productions converting
+        quantities with the UoMs
+        """
+        if uoms and cls.mass_balance_maintained():
+            uom_ids = [u.id for u in uoms]
+            cls.queue_mass_balance_lines(cls.search([
+                        ['OR',
+                            ('unit', 'in', uom_ids),
+                            ('inputs.unit', 'in', uom_ids),
+                            ('outputs.unit', 'in', uom_ids),
+                            ('inputs.product.template.default_uom', 'in',
+                                uom_ids),
+                            ('outputs.product.template.default_uom', 'in',
+                                uom_ids),
+                            ('bom.inputs.unit', 'in', uom_ids),
+                            ('bom.outputs.unit', 'in', uom_ids),
+                            ],
+                        ('state', 'in', ['running', 'done', 'cancelled']),
+                        ]))
+
+    @classmethod
+    def _update_mass_balance(cls, production_ids):
+        "Recompute the mass balance ledger of the existing productions"
+        Line = Pool().get('production.mass_balance.line')
+        productions = cls.search([('id', 'in', production_ids)])
+        if Line.enabled():
+            cls.update_mass_balance_lines(productions)
+
+    def mass_balance_report_data(self, requested_product, direction, lot=None,
+            cache=None):
+        if cache is None:
+            cache = MassBalanceCache()
+
+        quantity = 0.0
+        total_product = 0.0
+        for move in getattr(self, 'outputs'
+                if direction == 'backward' else 'inputs'):
+            if move.state == 'cancelled':
+                continue
+            if move.product == requested_product:
+                qty = cache.compute_qty(move.unit, move.quantity,
+                    move.product.default_uom)
+                total_product += qty
+                # skip moves that same product but different lot
+                if lot and lot != move.lot:
+                    continue
+                quantity += qty
+
+        moves = {}
+        for move in getattr(self, 'inputs'
+                if direction == 'backward' else 'outputs'):
+            if move.state == 'cancelled':
+                continue
+            product = move.product
+            mqty = cache.compute_qty(
+                move.unit, move.quantity, move.product.default_uom)
+            if moves.get(product):
+                moves[product] += mqty
+            else:
+                moves[product] = mqty
+
+        return self._mass_balance_result(requested_product, direction,
+            quantity, total_product, moves, cache=cache)
+
+    def _mass_balance_result(self, requested_product, direction, quantity,
+            total_product, moves, cache=None):
+        """
+        Return the mass balance of the production from the quantities
+        already converted to the default UoM of their products.
+
+        quantity is the quantity of requested_product (of the lot, if any)
+        and total_product the quantity of requested_product of all lots,
+        both on the side of the requested product. moves is a dict with the
+        quantity of each product on the other side.
+        """
+        if cache is None:
+            cache = MassBalanceCache()
+
+        digits = self.unit and self.unit.digits or 2
+        res = {}
+        for product, qty in moves.items():
+            prod = product if direction == 'backward' else requested_product
+            balance_consumption = ((((qty * quantity) / total_product)
+                    if total_product != 0. else 0)
+                if direction == 'backward' else quantity)
+
+            balance_plan_consumption = 0.0
+            balance_difference = 0.0
+            if self.bom:
+                factor = cache.bom_factor(self.bom, self.product, prod)
+                balance_plan_consumption = (
+                    product.default_uom.floor(
+                        self.quantity * factor))
+
+                if direction == 'backward':
+                    balance_difference = round(qty - balance_plan_consumption,
+                        digits)
+                else:
+                    balance_difference = round(
+                        quantity - balance_plan_consumption, digits)
+
+            balance_difference_percent = ((
+                    (balance_consumption - balance_plan_consumption) /
+                    balance_plan_consumption) * 100
+                if balance_consumption and balance_plan_consumption else 0.0)
+            record = res[product] = MassBalanceRecord(
+                requested_product.default_uom
+                if direction == 'backward' else product.default_uom,
+                prod.default_uom, default_uom=product.default_uom)
+            record.add(MassBalanceRow(self.id, self.rec_name, quantity,
+                    balance_consumption, balance_plan_consumption,
+                    balance_difference, balance_difference_percent))
+        return res
+
+    @classmethod
+    def mass_balance_engine(cls):
+        """
+        Return the engine used by the report to compute the mass balance.
+
+        'sql' aggregates the moves of all the productions with grouped
+        queries and 'orm' calls mass_balance_report_data on each production.
+        The 'orm' engine is used when mass_balance_report_data is overridden
+        so custom computations are kept. 'numpy' computes the balance of all
+        the productions with arrays when enabled in the configuration.
+        """
+        if (cls.mass_balance_report_data
+                is not Production.mass_balance_report_data):
+            return 'orm'
+        if numpy is not None and config.getboolean('production_mass_balance',
+                'numpy', default=False):
+            return 'numpy'
+        return 'sql'
+
+    @classmethod
+    def mass_balance_results(cls, productions, requested_product, direction,
+            lot=None, cache=None, engine=None):
+        "Return the mass balance of each production with the engine"
+        if engine is None:
+            engine = cls.mass_balance_engine()
+        if engine == 'sql':
+            return cls.mass_balance_report_data_sql(productions,
+                requested_product, direction, lot, cache=cache)
+        elif engine == 'numpy':
+            return cls.mass_balance_report_data_numpy(productions,
+                requested_product, direction, lot, cache=cache)
+        res = OrderedDict()
+        for i, production in enumerate(productions, 1):
+            res[production] = OrderedDict(
+                (product, MassBalanceRecord.from_dict(product, record)
+                    if isinstance(record, dict) else record)
+                for product, record in production.mass_balance_report_data(
+                    requested_product, direction, lot).items())
+            cls._mass_balance_progress(i, len(productions))
+        MassBalanceDiagnostics.count('productions', len(productions))
+        MassBalanceDiagnostics.count('moves',
+            sum(len(p.inputs) + len(p.outputs) for p in productions))
+        return res
+
+    @classmethod
+    def _mass_balance_progress(cls, done, total):
+        "Report the progress of the mass balance run being processed"
+        pool = Pool()
+        Run = pool.get('production.mass_balance.run')
+        run_id = Transaction().context.get('mass_balance_run')
+        if (run_id and total
+                and (done == total or done % max(total // 100, 1) == 0)):
+            Run.set_progress(run_id, done / total)
+
+    @classmethod
+    def mass_balance_report_data_sql(cls, productions, requested_product,
+            direction, lot=None, cache=None):
+        """
+        Return a dict with the result of mass_balance_report_data for each
+        production, computed from the moves aggregated in the database.
+        """
+        request = (requested_product, lot)
+        return cls.mass_balance_report_data_sql_batch(
+            {request: productions}, direction, cache=cache)[request]
+
+    @classmethod
+    def mass_balance_report_data_sql_batch(cls, requests, direction,
+            cache=None):
+        """
+        Return for each (requested_product, lot) of requests a dict with the
+        result of mass_balance_report_data for each of its productions.
+
+        requests is a dict with the productions of each requested product and
+        lot. The moves of the other side of each production are aggregated
+        and converted only once for all the requests.
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+
+        if cache is None:
+            cache = MassBalanceCache()
+
+        productions = list(OrderedDict.fromkeys(
+                p for request_productions in requests.values()
+                for p in request_productions))
+        requested_products = {p for p, _ in requests}
+        with_lot = any(lot for _, lot in requests)
+
+        requested_lines, components = cls._mass_balance_move_lines(
+            productions, requested_products, direction, with_lot)
+
+        MassBalanceDiagnostics.count('productions', len(productions))
+        MassBalanceDiagnostics.count('move_groups', len(requested_lines)
+            + sum(len(lines) for lines in components.values()))
+
+        products = Product.browse(list({product_id
+                    for lines in components.values()
+                    for product_id, _, _ in lines}))
+        products = {p.id: p for p in products}
+        products.update((p.id, p) for p in requested_products)
+
+        cache.load_boms({p.bom for p in productions if p.bom})
+
+        cache.load_uom_factors(
+            [(line[2], products[line[1]].default_uom)
+                for line in requested_lines]
+            + [(unit_id, products[product_id].default_uom)
+                for lines in components.values()
+                for product_id, unit_id, _ in lines])
+
+        totals = {}
+        lot_quantities = {}
+        for line in requested_lines:
+            production_id, product_id, unit_id = line[:3]
+            qty = cache.compute_qty(unit_id, line[-1],
+                products[product_id].default_uom)
+            key = (production_id, product_id)
+            totals[key] = totals.get(key, 0.0) + qty
+            if with_lot:
+                key += (line[3],)
+                lot_quantities[key] = lot_quantities.get(key, 0.0) + qty
+
+        result = {request: OrderedDict() for request in requests}
+        members = {request: set(request_productions)
+            for request, request_productions in requests.items()}
+        for i, production in enumerate(productions, 1):
+            moves = {}
+            for product_id, unit_id, qty in components.get(production.id, []):
+                product = products[product_id]
+                moves[product] = moves.get(product, 0.0) + cache.compute_qty(
+                    unit_id, qty, product.default_uom)
+            for (requested_product, lot), request_productions in (
+                    members.items()):
+                if production not in request_productions:
+                    continue
+                key = (production.id, requested_product.id)
+                total_product = totals.get(key, 0.0)
+                if lot:
+                    # skip moves that same product but different lot
+                    quantity = lot_quantities.get(key + (lot.id,), 0.0)
+                else:
+                    quantity = total_product
+                result[(requested_product, lot)][production] = (
+                    production._mass_balance_result(requested_product,
+                        direction, quantity, total_product, moves,
+                        cache=cache))
+            cls._mass_balance_progress(i, len(productions))
+        return result
+
+    @classmethod
+    def _mass_balance_move_lines(cls, productions, requested_products,
+            direction, with_lot=False):
+        """
+        Return the quantities of the moves of the productions summed by
+        production, product and unit
+
+        The first list has the lines of the requested products on the side
+        of the direction, also grouped by lot if with_lot. The second value
+        is a dict with the product, unit and quantity lines of the other
+        side of each production ordered by product.
+        """
+        pool = Pool()
+        Move = pool.get('stock.move')
+        move = Move.__table__()
+        cursor = Transaction().connection.cursor()
+
+        if direction == 'backward':
+            requested_column = move.production_output
+            component_column = move.production_input
+        else:
+            requested_column = move.production_input
+            component_column = move.production_output
+
+        requested_lines = []
+        components = {}
+        for sub_productions in grouped_slice(productions):
+            sub_ids = [p.id for p in sub_productions]
+
+            columns = [requested_column, move.product, move.unit]
+            if with_lot:
+                columns.append(move.lot)
+            cursor.execute(*move.select(*columns, Sum(move.quantity),
+                    where=(reduce_ids(requested_column, sub_ids)
+                        & move.product.in_([p.id for p in requested_products])
+                        & (move.state != 'cancelled')),
+                    group_by=columns))
+            requested_lines.extend(cursor)
+
+            cursor.execute(*move.select(
+                    component_column, move.product, move.unit,
+                    Sum(move.quantity),
+                    where=(reduce_ids(component_column, sub_ids)
+                        & (move.state != 'cancelled')),
+                    group_by=[component_column, move.product, move.unit],
+                    order_by=[component_column, move.product]))
+            for production_id, product_id, unit_id, qty in cursor:
+                components.setdefault(production_id, []).append(
+                    (product_id, unit_id, qty))
+        return requested_lines, components
+
+    @classmethod
+    def mass_balance_report_data_numpy(cls, productions, requested_product,
+            direction, lot=None, cache=None):
+        """
+        Return the same result as mass_balance_report_data_sql computing the
+        balance columns of all the productions with NumPy arrays
+
+        The rounding of the plan consumption and of the difference uses the
+        same functions on each value so the results are identical.
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+
+        if cache is None:
+            cache = MassBalanceCache()
+
+        productions = list(productions)
+        result = OrderedDict((p, {}) for p in productions)
+        requested_lines, components = cls._mass_balance_move_lines(
+            productions, {requested_product}, direction, bool(lot))
+        MassBalanceDiagnostics.count('productions', len(productions))
+        MassBalanceDiagnostics.count('move_groups', len(requested_lines)
+            + sum(len(lines) for lines in components.values()))
+        if not components:
+            cls._mass_balance_progress(len(productions), len(productions))
+            return result
+
+        index = {p.id: i for i, p in enumerate(productions)}
+        products = Product.browse(list({product_id
+                    for lines in components.values()
+                    for product_id, _, _ in lines}))
+        products = {p.id: p for p in products}
+        cache.load_boms({p.bom for p in productions if p.bom})
+
+        def factors(from_ids, to_ids):
+            "Return the UoM factor of each pair of the arrays"
+            pairs, inverse = numpy.unique(
+                numpy.stack([from_ids, to_ids], axis=1), axis=0,
+                return_inverse=True)
+            cache.load_uom_factors(pairs.tolist())
+            values = numpy.array([cache.uom_factor(f, t)
+                    for f, t in pairs.tolist()], dtype=float)
+            return values[inverse.reshape(-1)]
+
+        # quantities of the requested product by production
+        totals = numpy.zeros(len(productions))
+        quantities = totals
+        if requested_lines:
+            lines = numpy.array([(index[l[0]], l[2], l[-1])
+                    for l in requested_lines], dtype=float)
+            rows = lines[:, 0].astype(int)
+            qty = lines[:, 2] * factors(lines[:, 1].astype(int),
+                numpy.full(len(lines), requested_product.default_uom.id))
+            numpy.add.at(totals, rows, qty)
+            if lot:
+                quantities = numpy.zeros(len(productions))
+                mask = numpy.array([l[3] == lot.id for l in requested_lines])
+                numpy.add.at(quantities, rows[mask], qty[mask])
+
+        # quantities of the other side by production and product
+        lines = numpy.array([(index[production_id], product_id, unit_id,
+                    products[product_id].default_uom.id, qty)
+                for production_id, lines in components.items()
+                for product_id, unit_id, qty in lines], dtype=float)
+        qty = lines[:, 4] * factors(lines[:, 2].astype(int),
+            lines[:, 3].astype(int))
+        keys, inverse = numpy.unique(lines[:, :2].astype(int), axis=0,
+            return_inverse=True)
+        moves = numpy.zeros(len(keys))
+        numpy.add.at(moves, inverse.reshape(-1), qty)
+        rows = keys[:, 0]
+
+        quantity = quantities[rows]
+        if direction == 'backward':
+            total = totals[rows]
+            consumption = numpy.divide(moves * quantity, total,
+                out=numpy.zeros(len(keys)), where=total != 0)
+        else:
+            consumption = quantity.copy()
+
+        # plan consumption and difference are rounded like the other engines
+        pairs = [(productions[row], products[product_id])
+            for row, product_id in keys.tolist()]
+        has_bom = numpy.array([bool(p.bom) for p, _ in pairs])
+        bom_factors = numpy.array([cache.bom_factor(production.bom,
+                    production.product,
+                    product if direction == 'backward' else requested_product)
+                if production.bom else 0.0
+                for production, product in pairs], dtype=float)
+        production_quantities = numpy.array([p.quantity or 0.0
+                for p, _ in pairs], dtype=float)
+        plans = production_quantities * bom_factors
+        plan = numpy.array([product.default_uom.floor(value) if bom else 0.0
+                for (_, product), value, bom in zip(pairs, plans.tolist(),
+                    has_bom.tolist())], dtype=float)
+        differences = (moves if direction == 'backward' else quantity) - plan
+        difference = numpy.array([
+                round(value, production.unit and production.unit.digits or 2)
+                if bom else 0.0
+                for (production, _), value, bom in zip(pairs,
+                    differences.tolist(), has_bom.tolist())], dtype=float)
+        percent = numpy.divide(consumption - plan, plan,
+            out=numpy.zeros(len(keys)),
+            where=(consumption != 0) & (plan != 0)) * 100
+
+        for (production, product), values in zip(pairs, zip(
+                    quantity.tolist(), consumption.tolist(), plan.tolist(),
+                    difference.tolist(), percent.tolist())):
+            prod = product if direction == 'backward' else requested_product
+            record = result[production][product] = MassBalanceRecord(
+                requested_product.default_uom
+                if direction == 'backward' else product.default_uom,
+                prod.default_uom, default_uom=product.default_uom)
+            record.add(MassBalanceRow(production.id, production.rec_name,
+                    *values))
+        cls._mass_balance_progress(len(productions), len(productions))
+        return result
+
+    @classmethod
+    def mass_balance_lookup(cls, requests, direction, from_date=None,
+            to_date=None, cache=None):
+        """
+        Return for each (requested_product, lot) of requests an ordered dict
+        with the productions of the company with a done move of the product
+        and lot in the dates on the side of the direction and the quantity
+        of these moves in the default UoM of the product.
+
+        The same move must match all the conditions and all the requests are
+        looked up at once with a single query.
+        """
+        cursor = Transaction().connection.cursor()
+
+        if cache is None:
+            cache = MassBalanceCache()
+
+        products = {p.id: p for p, _ in requests}
+        cursor.execute(*cls._mass_balance_lookup_query(requests, direction,
+                from_date=from_date, to_date=to_date))
+        lines = list(cursor)
+
+        productions = cls.browse(list(OrderedDict.fromkeys(
+                    line[0] for line in lines)))
+        productions = {p.id: p for p in productions}
+        cache.load_uom_factors((line[2], products[line[1]].default_uom)
+            for line in lines)
+        result = OrderedDict((request, OrderedDict()) for request in requests)
+        for line in lines:
+            production = productions[line[0]]
+            product = products[line[1]]
+            qty = cache.compute_qty(line[2], line[-1], product.default_uom)
+            for requested_product, lot in requests:
+                if (requested_product == product
+                        and (not lot or line[3] == lot.id)):
+                    found = result[(requested_product, lot)]
+                    found[production] = found.get(production, 0.0) + qty
+        return result
+
+    @classmethod
+    def _mass_balance_lookup_query(cls, requests, direction, from_date=None,
+            to_date=None):
+        """
+        Return the query of mass_balance_lookup
+
+        It returns the production, product, unit, lot when any request has
+        one, and the summed quantity of the moves.
+        """
+        pool = Pool()
+        Move = pool.get('stock.move')
+        table = cls.__table__()
+        move = Move.__table__()
+        company_id = Transaction().context.get('company')
+
+        requested_column = (move.production_output
+            if direction == 'backward' else move.production_input)
+        with_lot = any(lot for _, lot in requests)
+
+        where = ((table.company == company_id)
+            & move.product.in_(list({p.id for p, _ in requests}))
+            & (move.state == 'done'))
+        if from_date:
+            where &= move.effective_date >= from_date
+        if to_date:
+            where &= move.effective_date <= to_date
+        columns = [table.id, move.product, move.unit]
+        if with_lot:
+            columns.append(move.lot)
+        return table.join(move,
+            condition=requested_column == table.id
+            ).select(*columns, Sum(move.quantity),
+            where=where, group_by=columns, order_by=[table.id])
+
+    @classmethod
+    def mass_balance_search(cls, requests, direction, from_date=None,
+            to_date=None):
+        """
+        Return for each (requested_product, lot) of requests the productions
+        with a done move of the product and lot in the dates on the side of
+        the direction, searching all of them at once.
+        """
+        return OrderedDict((request, list(productions))
+            for request, productions in cls.mass_balance_lookup(
+                requests, direction, from_date, to_date).items())
+
+    @classmethod
+    def update_mass_balance_lines(cls, productions):
+        """
+        Recompute the mass balance ledger lines of the productions
+
+        A line is stored for each product of the other side of every product
+        with done moves on each side of the running, done or cancelled
+        productions. The lines of the other productions are deleted.
+        """
+        pool = Pool()
+        Line = pool.get('production.mass_balance.line')
+        Move = pool.get('stock.move')
+        Product = pool.get('product.product')
+        move = Move.__table__()
+        cursor = Transaction().connection.cursor()
+
+        productions = cls.browse(list({p.id for p in productions}))
+        if not productions:
+            return
+
+        with without_check_access():
+            Line.delete(Line.search([
+                        ('production', 'in', [p.id for p in productions]),
+                        ]))
+        productions = [p for p in productions
+            if p.state in {'running', 'done', 'cancelled'}]
+        if not productions:
+            return
+
+        cache = MassBalanceCache()
+        to_create = []
+        for direction, column in [
+                ('backward', move.production_output),
+                ('forward', move.production_input),
+                ]:
+            dates = OrderedDict()
+            for sub_productions in grouped_slice(productions):
+                sub_ids = [p.id for p in sub_productions]
+                cursor.execute(*move.select(
+                        column, move.product, Max(move.effective_date),
+                        where=(reduce_ids(column, sub_ids)
+                            & (move.state == 'done')),
+                        group_by=[column, move.product],
+                        order_by=[move.product, column]))
+                for production_id, product_id, date in cursor:
+                    dates.setdefault(product_id, {})[production_id] = date
+
+            for product_id, production_dates in dates.items():
+                requested_product = Product(product_id)
+                results = cls.mass_balance_results(
+                    cls.browse(list(production_dates)), requested_product,
+                    direction, cache=cache)
+                for production, res in results.items():
+                    for product, record in res.items():
+                        for row in record.rows:
+                            to_create.append({
+                                    'production': production.id,
+                                    'company': production.company.id,
+                                    'direction': direction,
+                                    'requested_product': product_id,
+                                    'product': product.id,
+                                    'date': production_dates[production.id],
+                                    'quantity': row.quantity,
+                                    'consumption': row.consumption,
+                                    'plan_consumption': row.plan_consumption,
+                                    'difference': row.difference,
+                                    'difference_percent': (
+                                        row.difference_percent),
+                                    })
+        if to_create:
+            with without_check_access():
+                Line.create(to_create)
+
+    @classmethod
+    def mass_balance_genealogy(cls, requested_product, direction, lot=None,
+            depth=1, from_date=None, to_date=None):
+        """
+        Return the (production, product, lot) ids found at each level of the
+        production chain of requested_product.
+
+        The first level are the productions of the report. Each next level
+        are the productions that produced (backward) or consumed (forward)
+        the products and lots of the other side of the previous level. When
+        the move has no lot, only the productions done before (backward) or
+        after (forward) it are followed.
+        """
+        cursor = Transaction().connection.cursor()
+        tree = cls._mass_balance_genealogy_query(requested_product,
+            direction, lot, depth, from_date, to_date)
+        cursor.execute(*tree.select(
+                tree.level, tree.production, tree.product, tree.lot,
+                with_=[tree],
+                order_by=[tree.level, tree.product, tree.lot,
+                    tree.production]))
+
+        levels = OrderedDict()
+        for level, production_id, product_id, lot_id in cursor:
+            levels.setdefault(level, []).append(
+                (production_id, product_id, lot_id))
+        return levels
+
+    @classmethod
+    def _mass_balance_genealogy_query(cls, requested_product, direction,
+            lot=None, depth=1, from_date=None, to_date=None):
+        """
+        Return the recursive query of mass_balance_genealogy with the level,
+        production, product and lot columns
+        """
+        pool = Pool()
+        Move = pool.get('stock.move')
+        try:
+            Lot = pool.get('stock.lot')
+        except KeyError:
+            Lot = None
+        move = Move.__table__()
+        component = Move.__table__()
+        parent = Move.__table__()
+        company_id = Transaction().context.get('company')
+
+        def requested_column(table):
+            return (table.production_output if direction == 'backward'
+                else table.production_input)
+
+        def component_column(table):
+            return (table.production_input if direction == 'backward'
+                else table.production_output)
+
+        def lot_column(table):
+            return table.lot if Lot else Literal(None)
+
+        where = ((move.product == requested_product.id)
+            & (requested_column(move) != Null)
+            & (move.state == 'done')
+            & (move.company == company_id))
+        if from_date:
+            where &= move.effective_date >= from_date
+        if to_date:
+            where &= move.effective_date <= to_date
+        if lot:
+            where &= move.lot == lot.id
+
+        tree = With('level', 'production', 'product', 'lot', recursive=True)
+        condition = ((parent.product == component.product)
+            & (requested_column(parent) != Null)
+            & (parent.state == 'done')
+            & (parent.company == company_id))
+        # without lot, only the productions done before the consumption
+        # (backward) or after the production (forward) can be linked
+        if direction == 'backward':
+            dated = parent.effective_date <= component.effective_date
+        else:
+            dated = parent.effective_date >= component.effective_date
+        if Lot:
+            condition &= (((component.lot == Null) & dated)
+                | (parent.lot == component.lot))
+        else:
+            condition &= dated
+        tree.query = move.select(Literal(1), requested_column(move),
+            move.product, lot_column(move), where=where)
+        tree.query |= tree.join(component,
+            condition=component_column(component) == tree.production
+            ).join(parent, condition=condition
+            ).select(tree.level + 1, requested_column(parent),
+                component.product, lot_column(component),
+                where=(tree.level < depth) & (component.state == 'done'))
+        return tree
+
+
+class ProductionMassBalanceLine(ModelSQL, ModelView):
+    'Production Mass Balance Line'
+    __name__ = 'production.mass_balance.line'
+    production = fields.Many2One('production', 'Production', required=True,
+        ondelete='CASCADE')
+    company = fields.Many2One('company.company', 'Company', required=True)
+    direction = fields.Selection(DIRECTIONS, 'Direction', required=True)
+    requested_product = fields.Many2One('product.product',
+        'Requested Product', required=True)
+    product = fields.Many2One('product.product', 'Product', required=True)
+    date = fields.Date('Date', required=True)
+    quantity = fields.Float('Quantity', readonly=True)
+    consumption = fields.Float('Consumption', readonly=True)
+    plan_consumption = fields.Float('Plan Consumption', readonly=True)
+    difference = fields.Float('Difference', readonly=True)
+    difference_percent = fields.Float('% Difference', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t,
+                    (t.requested_product, Index.Equality()),
+                    (t.direction, Index.Equality()),
+                    (t.company, Index.Equality()),
+                    (t.date, Index.Range())),
+                })
+        cls._order.insert(0, ('production', 'ASC'))
+
+    @classmethod
+    def enabled(cls):
+        "Return if the mass balance ledger is maintained"
+        return config.getboolean('production_mass_balance', 'ledger',
+            default=False)
+
+    @property
+    def mass_balance_uoms(self):
+        "Return the UoMs of quantity and of the other columns"
+        if self.direction == 'backward':
+            return (self.requested_product.default_uom,
+                self.product.default_uom)
+        return self.product.default_uom, self.requested_product.default_uom
+
+    def get_mass_balance_row(self):
+        "Return the row of the line like the report productions"
+        return MassBalanceRow(self.production.id, self.production.rec_name,
+            self.quantity, self.consumption, self.plan_consumption,
+            self.difference, self.difference_percent)
+
+
+class ProductionMassBalanceCache(ModelSQL):
+    'Production Mass Balance Cache'
+    __name__ = 'production.mass_balance.cache'
+    key = fields.Char('Key', required=True)
+    stamp = fields.Char('Stamp', required=True)
+    company = fields.Many2One('company.company', 'Company', required=True,
+        ondelete='CASCADE')
+    product = fields.Many2One('product.product', 'Product', required=True,
+        ondelete='CASCADE')
+    direction = fields.Selection(DIRECTIONS, 'Direction', required=True)
+    from_date = fields.Date('From Date')
+    to_date = fields.Date('To Date')
+    result = fields.Text('Result')
+    hits = fields.Integer('Hits', required=True)
+    last_access = fields.Timestamp('Last Access', required=True)
+    precomputed = fields.Boolean('Precomputed')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.key, Index.Equality())),
+                Index(t, (t.last_access, Index.Range())),
+                })
+
+    @staticmethod
+    def default_hits():
+        return 0
+
+    @staticmethod
+    def default_last_access():
+        return datetime.now()
+
+    @classmethod
+    def size(cls):
+        "Return the maximum number of results kept"
+        return config.getint('production_mass_balance', 'cache_size',
+            default=0)
+
+    @classmethod
+    def get_key(cls, data, company_id):
+        "Return the key of the report data"
+        key = {}
+        for name in cls._key_fields():
+            value = data.get(name)
+            # empty values of the wizard are the same as missing ones
+            if value == [] or value is False:
+                value = None
+            key[name] = value
+        key['depth'] = data.get('depth') or 1
+        key['company'] = company_id
+        # results stored with a former format are not used
+        key['version'] = 4
+        key = json.dumps(key, cls=JSONEncoder, sort_keys=True)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def _key_fields(cls):
+        return ['product', 'lot', 'products', 'lots', 'direction',
+            'from_date', 'to_date', 'depth', 'engine', 'trend',
+            'deviation_limit', 'deviation_threshold', 'deviation_percentage']
+
+    @classmethod
+    def get_stamp(cls, requests, direction, from_date=None, to_date=None,
+            depth=1):
+        """
+        Return the stamp of the moves and productions used by the report
+
+        The stamp changes when one of them is created, written or deleted.
+        Only the productions found by the lookup of the requests in the
+        company and the dates are checked, or those of the genealogy when
+        the report follows it. The BOMs and UoMs are included by
+        get_definition_stamp.
+        """
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Production = pool.get('production')
+        move = Move.__table__()
+        production = Production.__table__()
+        cursor = Transaction().connection.cursor()
+
+        if depth > 1 and len(requests) == 1:
+            (requested_product, lot), = requests
+            tree = Production._mass_balance_genealogy_query(
+                requested_product, direction, lot, depth, from_date, to_date)
+            productions = tree.select(tree.production, with_=[tree])
+        else:
+            lookup = Production._mass_balance_lookup_query(requests,
+                direction, from_date, to_date)
+            productions = lookup.select(lookup.id)
+
+        stamp = []
+        # each side of the moves is checked alone so its index is used
+        for sql_table, where in [
+                (move, move.production_input.in_(productions)),
+                (move, move.production_output.in_(productions)),
+                (production, production.id.in_(productions)),
+                ]:
+            cursor.execute(*sql_table.select(
+                    Max(Coalesce(sql_table.write_date, sql_table.create_date)),
+                    Count(Literal('*')),
+                    where=where))
+            stamp.extend(str(v) for v in cursor.fetchone())
+        stamp.append(cls.get_definition_stamp())
+        return '|'.join(stamp)
+
+    @classmethod
+    def get_definition_stamp(cls):
+        """
+        Return the stamp of the BOMs and UoMs used to compute the plan
+        consumption and to convert the quantities
+        """
+        pool = Pool()
+        cursor = Transaction().connection.cursor()
+
+        stamp = []
+        for name in ['production.bom', 'production.bom.input',
+                'production.bom.output', 'product.uom']:
+            table = pool.get(name).__table__()
+            cursor.execute(*table.select(
+                    Max(Coalesce(table.write_date, table.create_date)),
+                    Count(Literal('*'))))
+            stamp.extend(str(v) for v in cursor.fetchone())
+        return '|'.join(stamp)
+
+    @classmethod
+    def get(cls, key, stamp):
+        "Return the result stored for key if it is still valid"
+        with without_check_access():
+            caches = cls.search([
+                    ('key', '=', key),
+                    ('stamp', '=', stamp),
+                    ], limit=1)
+        if not caches:
+            return
+        cache, = caches
+        if Transaction().context.get('mass_balance_precompute'):
+            return load_records(
+                json.loads(cache.result, object_hook=JSONDecoder()))
+        table = cls.__table__()
+        with writable_transaction() as transaction:
+            cursor = transaction.connection.cursor()
+            # the same clock as the default and the precomputation
+            cursor.execute(*table.update(
+                    [table.hits, table.last_access],
+                    [table.hits + 1, datetime.now()],
+                    where=table.id == cache.id))
+        return load_records(json.loads(cache.result, object_hook=JSONDecoder()))
+
+    @classmethod
+    def set(cls, key, stamp, result, data, company_id):
+        "Store the result for key and evict the least recently used ones"
+        size = cls.size()
+        try:
+            with writable_transaction(), without_check_access():
+                cls.delete(cls.search([('key', '=', key)]))
+                cls.create([{
+                            'key': key,
+                            'stamp': stamp,
+                            'company': company_id,
+                            'product': data['product'],
+                            'direction': data['direction'],
+                            'from_date': data.get('from_date'),
+                            'to_date': data.get('to_date'),
+                            'result': json.dumps(dump_records(result),
+                                cls=JSONEncoder, separators=(',', ':')),
+                            'precomputed': bool(Transaction().context.get(
+                                    'mass_balance_precompute')),
+                            }])
+                cls.delete(cls.search([], offset=size,
+                        order=[('last_access', 'DESC'), ('id', 'DESC')]))
+        except (backend.DatabaseIntegrityError,
+                backend.DatabaseOperationalError):
+            logger.warning('Unable to store mass balance result %s', key,
+                exc_info=True)
+
+    @classmethod
+    def precompute(cls):
+        """
+        Store the results of the reports of the configured products and of
+        the most requested ones for the usual ranges of dates
+
+        It is run by a scheduled task at off-peak times so the reports
+        requested with the same parameters are served from the cache.
+        """
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Report = pool.get('production.mass_balance.report', type='report')
+
+        if not cls.size():
+            return
+        requests = cls._precompute_requests()
+        for company_id, product_id, direction in requests:
+            with Transaction().set_context(company=company_id,
+                    mass_balance_precompute=True):
+                for from_date, to_date in cls._precompute_dates(
+                        Date.today()):
+                    data = {
+                        'product': product_id,
+                        'direction': direction,
+                        'from_date': from_date,
+                        'to_date': to_date,
+                        }
+                    try:
+                        Report.prepare(data)
+                    except UserError:
+                        logger.warning(
+                            'Unable to precompute mass balance %s',
+                            data, exc_info=True)
+
+    @classmethod
+    def _precompute_requests(cls):
+        """
+        Return the company, product id and direction of the reports to
+        precompute
+
+        These are the products of the precompute_products configuration,
+        given by code, backward for each company followed by the products
+        and directions with the most requests in the last precompute_days.
+        """
+        pool = Pool()
+        Company = pool.get('company.company')
+        Product = pool.get('product.product')
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        requests = []
+        codes = [c.strip() for c in config.get('production_mass_balance',
+                'precompute_products', default='').split(',') if c.strip()]
+        if codes:
+            with without_check_access():
+                products = Product.search([('code', 'in', codes)])
+                companies = Company.search([])
+            requests.extend((c.id, p.id, 'backward')
+                for c in companies for p in products)
+
+        limit = config.getint('production_mass_balance', 'precompute_limit',
+            default=20)
+        days = config.getint('production_mass_balance', 'precompute_days',
+            default=7)
+        if limit:
+            # the results stored by the precomputation are not requests
+            requested = Sum(table.hits + Case(
+                    (table.precomputed == Literal(True), 0), else_=1))
+            cursor.execute(*table.select(
+                    table.company, table.product, table.direction,
+                    where=table.last_access >= (
+                        datetime.now() - timedelta(days=days)),
+                    group_by=[table.company, table.product, table.direction],
+                    having=requested > 0,
+                    order_by=[requested.desc, table.product],
+                    limit=limit))
+            requests.extend(tuple(r) for r in cursor)
+        return list(OrderedDict.fromkeys(requests))
+
+    @classmethod
+    def _precompute_dates(cls, date):
+        "Return the ranges of dates of the last week, last month and year"
+        week = date - timedelta(days=date.weekday() + 7)
+        month = date.replace(day=1) - timedelta(days=1)
+        return [
+            (week, week + timedelta(days=6)),
+            (month.replace(day=1), month),
+            (date.replace(month=1, day=1), date),
+            ]
+
+
+class ProductionMassBalanceDay(ModelSQL):
+    'Production Mass Balance Day'
+    __name__ = 'production.mass_balance.day'
+    company = fields.Many2One('company.company', 'Company', required=True,
+        ondelete='CASCADE')
+    requested_product = fields.Many2One('product.product',
+        'Requested Product', required=True, ondelete='CASCADE')
+    lot = fields.Integer('Lot')
+    direction = fields.Selection(DIRECTIONS, 'Direction', required=True)
+    engine = fields.Char('Engine', required=True)
+    date = fields.Date('Date', required=True)
+    stamp = fields.Char('Stamp', required=True)
+    result = fields.Text('Result')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t,
+                    (t.requested_product, Index.Equality()),
+                    (t.direction, Index.Equality()),
+                    (t.company, Index.Equality()),
+                    (t.date, Index.Range())),
+                })
+
+    @classmethod
+    def enabled(cls):
+        "Return if the reports are computed from the results of each day"
+        return config.getboolean('production_mass_balance', 'incremental',
+            default=False)
+
+    @classmethod
+    def max_age(cls):
+        "Return the number of days before today whose results are kept"
+        return config.getint('production_mass_balance', 'incremental_days',
+            default=365)
+
+    @classmethod
+    def get_days(cls, company_id, requested_product, direction, lot,
+            from_date, to_date):
+        """
+        Return for each day with productions of the report the stamp of
+        these productions and their ids
+
+        A production is in each day with a done move of the requested
+        product and lot on the side of the direction. The stamp changes when
+        one of the productions or of their moves is created, written or
+        deleted, when the productions of the day change and when the BOMs or
+        the UoMs change.
+        """
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Production = pool.get('production')
+        Cache = pool.get('production.mass_balance.cache')
+        move = Move.__table__()
+        related = Move.__table__()
+        production = Production.__table__()
+        cursor = Transaction().connection.cursor()
+
+        definition_stamp = Cache.get_definition_stamp()
+
+        requested_column = (move.production_output
+            if direction == 'backward' else move.production_input)
+        where = ((production.company == company_id)
+            & (move.product == requested_product.id)
+            & (move.state == 'done')
+            & (move.effective_date >= from_date)
+            & (move.effective_date <= to_date))
+        if lot:
+            where &= move.lot == lot.id
+        matched = production.join(move,
+            condition=requested_column == production.id
+            ).select(
+                move.effective_date.as_('date'),
+                production.id.as_('production'),
+                Max(Coalesce(production.write_date, production.create_date)
+                    ).as_('stamp'),
+                where=where,
+                group_by=[move.effective_date, production.id])
+        cursor.execute(*matched.join(related,
+                condition=(related.production_input == matched.production)
+                | (related.production_output == matched.production)
+                ).select(matched.date, matched.production,
+                Max(matched.stamp),
+                Max(Coalesce(related.write_date, related.create_date)),
+                Count(related.id),
+                group_by=[matched.date, matched.production],
+                order_by=[matched.date, matched.production]))
+
+        days = OrderedDict()
+        for date, production_id, production_stamp, move_stamp, moves in (
+                cursor):
+            if isinstance(date, str):
+                date = datetime.fromisoformat(date).date()
+            stamps, production_ids = days.setdefault(date, ([], []))
+            stamps.append('%s:%s:%s:%s' % (
+                    production_id, production_stamp, move_stamp, moves))
+            production_ids.append(production_id)
+        return OrderedDict((date, (
+                    hashlib.sha256('|'.join(
+                            stamps + [definition_stamp]).encode(
+                            'utf-8')).hexdigest(),
+                    production_ids))
+            for date, (stamps, production_ids) in days.items())
+
+    @classmethod
+    def get_results(cls, company_id, requested_product, direction, lot,
+            engine, days):
+        """
+        Return for each of the days which are still valid the result
+        stored for each of its productions
+
+        days is the result of get_days.
+        """
+        with without_check_access():
+            records = cls.search([
+                    ('company', '=', company_id),
+                    ('requested_product', '=', requested_product.id),
+                    ('lot', '=', lot.id if lot else None),
+                    ('direction', '=', direction),
+                    ('engine', '=', engine),
+                    ('date', 'in', list(days)),
+                    ])
+        results = {}
+        for record in records:
+            if days[record.date][0] == record.stamp:
+                results[record.date] = dict(load_records(json.loads(
+                            record.result, object_hook=JSONDecoder())))
+        return results
+
+    @classmethod
+    def set_results(cls, company_id, requested_product, direction, lot,
+            engine, days, results):
+        """
+        Store the results of each production for the days
+
+        days contains the stamp and productions of the days to store and
+        results the result of each production of these days. The days older
+        than max_age are not stored and the stored ones are evicted.
+        """
+        pool = Pool()
+        Date = pool.get('ir.date')
+
+        max_age = cls.max_age()
+        if max_age:
+            oldest = Date.today() - timedelta(days=max_age)
+            days = OrderedDict((date, value) for date, value in days.items()
+                if date >= oldest)
+        try:
+            with writable_transaction(), without_check_access():
+                if max_age:
+                    cls.delete(cls.search([('date', '<', oldest)]))
+                cls.delete(cls.search([
+                            ('company', '=', company_id),
+                            ('requested_product', '=', requested_product.id),
+                            ('lot', '=', lot.id if lot else None),
+                            ('direction', '=', direction),
+                            ('engine', '=', engine),
+                            ('date', 'in', list(days)),
+                            ]))
+                cls.create([{
+                            'company': company_id,
+                            'requested_product': requested_product.id,
+                            'lot': lot.id if lot else None,
+                            'direction': direction,
+                            'engine': engine,
+                            'date': date,
+                            'stamp': stamp,
+                            'result': json.dumps(dump_records(
+                                    [[i, results[i]] for i in production_ids]),
+                                cls=JSONEncoder, separators=(',', ':')),
+                            } for date, (stamp, production_ids)
+                        in days.items()])
+        except (backend.DatabaseIntegrityError,
+                backend.DatabaseOperationalError):
+            logger.warning('Unable to store mass balance days of %s',
+                requested_product.id, exc_info=True)
+
+
+class ProductionMassBalanceRun(ModelSQL, ModelView):
+    'Production Mass Balance Run'
+    __name__ = 'production.mass_balance.run'
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True)
+    product = fields.Many2One('product.product', 'Product', required=True,
+        readonly=True)
+    from_date = fields.Date('From Date', readonly=True)
+    to_date = fields.Date('To Date', readonly=True)
+    direction = fields.Selection(DIRECTIONS, 'Direction', required=True,
+        readonly=True)
+    depth = fields.Integer('Depth', required=True, readonly=True)
+    products = fields.Many2Many('production.mass_balance.run-product.product',
+        'run', 'product', 'Other Products', readonly=True)
+    output_format = fields.Selection(EXPORT_FORMATS, 'Format', required=True,
+        readonly=True)
+    trend = fields.Selection(TREND_BUCKETS, 'Trend', readonly=True)
+    deviation_limit = fields.Integer('Largest Deviations', readonly=True)
+    deviation_threshold = fields.Float('Deviation Threshold', readonly=True)
+    deviation_percentage = fields.Boolean('Deviation in Percentage',
+        readonly=True)
+    state = fields.Selection([
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+        ], 'State', required=True, readonly=True)
+    progress = fields.Float('Progress', digits=(1, 4), readonly=True)
+    error = fields.Text('Error', readonly=True,
+        states={
+            'invisible': Eval('state') != 'failed',
+            })
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        try:
+            Lot = Pool().get('stock.lot')
+        except KeyError:
+            Lot = None
+        if Lot:
+            cls.lot = fields.Many2One('stock.lot', 'Lot', readonly=True)
+            cls.lots = fields.Many2Many('production.mass_balance.run-stock.lot',
+                'run', 'lot', 'Other Lots', readonly=True)
+        cls._order.insert(0, ('create_date', 'DESC'))
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+    @staticmethod
+    def default_depth():
+        return 1
+
+    @staticmethod
+    def default_state():
+        return 'queued'
+
+    @staticmethod
+    def default_output_format():
+        return 'html'
+
+    @staticmethod
+    def default_progress():
+        return 0.0
+
+    def get_rec_name(self, name):
+        return '%s (%s)' % (self.product.rec_name, self.direction_string)
+
+    @classmethod
+    def create_from_data(cls, data):
+        "Create a run for the report data"
+        values = {
+            'product': data['product'],
+            'from_date': data.get('from_date'),
+            'to_date': data.get('to_date'),
+            'direction': data['direction'],
+            'depth': data.get('depth') or 1,
+            'products': [('add', data.get('products') or [])],
+            'output_format': data.get('output_format') or 'html',
+            'trend': data.get('trend'),
+            'deviation_limit': data.get('deviation_limit'),
+            'deviation_threshold': data.get('deviation_threshold'),
+            'deviation_percentage': bool(data.get('deviation_percentage')),
+            }
+        if hasattr(cls, 'lot'):
+            values['lot'] = data.get('lot')
+            values['lots'] = [('add', data.get('lots') or [])]
+        run, = cls.create([values])
+        return run
+
+    def get_report_data(self):
+        "Return the data to execute the report of the run"
+        data = {
+            'direction': self.direction,
+            'from_date': self.from_date,
+            'to_date': self.to_date,
+            'product': self.product.id,
+            'depth': self.depth,
+            'products': [p.id for p in self.products],
+            'output_format': self.output_format,
+            'trend': self.trend,
+            'deviation_limit': self.deviation_limit,
+            'deviation_threshold': self.deviation_threshold,
+            'deviation_percentage': self.deviation_percentage,
+            'model': self.__name__,
+            'ids': [self.id],
+            }
+        if hasattr(self, 'lot'):
+            data['lot'] = self.lot.id if self.lot else None
+            data['lots'] = [l.id for l in self.lots]
+        return data
+
+    @classmethod
+    def set_progress(cls, run_id, progress, state=None):
+        """
+        Store the progress of the run in its own transaction so it is visible
+        while the run is processed
+        """
+        table = cls.__table__()
+        columns, values = [table.progress], [progress]
+        if state:
+            columns.append(table.state)
+            values.append(state)
+        try:
+            with Transaction().new_transaction() as transaction:
+                cursor = transaction.connection.cursor()
+                cursor.execute(*table.update(columns, values,
+                        where=table.id == run_id))
+                transaction.commit()
+        except backend.DatabaseOperationalError:
+            logger.debug('Unable to store progress of mass balance run %s',
+                run_id, exc_info=True)
+
+    @classmethod
+    def set_failed(cls, run_id, error, rec_name, user_id):
+        """
+        Store the failure of the run and notify its user in a new transaction
+        as the one of the run may be aborted by the error
+        """
+        table = cls.__table__()
+        with Transaction().new_transaction() as transaction:
+            cursor = transaction.connection.cursor()
+            cursor.execute(*table.update(
+                    [table.state, table.error], ['failed', error],
+                    where=table.id == run_id))
+            notify(gettext('production_mass_balance_report'
+                    '.msg_mass_balance_run_failed',
+                    run=rec_name),
+                priority=3, user=user_id)
+            transaction.commit()
+
+    @classmethod
+    def process(cls, runs):
+        "Compute the report of the runs and attach it to them"
+        with without_check_access():
+            for run in runs:
+                cls._process(run)
+
+    @classmethod
+    def _process(cls, run):
+        pool = Pool()
+        Attachment = pool.get('ir.attachment')
+        Report = pool.get('production.mass_balance.report', type='report')
+
+        if run.state not in {'queued', 'running'}:
+            return
+        # read before the transaction may be aborted by an error
+        rec_name, user_id = run.rec_name, run.create_uid.id
+        cls.set_progress(run.id, 0.0, state='running')
+        try:
+            with Transaction().set_context(mass_balance_run=run.id):
+                oext, content, _, name = Report.execute(
+                    [], run.get_report_data())
+        except backend.DatabaseOperationalError:
+            # the queue retries the run
+            raise
+        except Exception as exception:
+            logger.exception('Mass balance run %s failed', run.id)
+            cls.set_failed(run.id, str(exception), rec_name, user_id)
+            return
+        Attachment.create([{
+                    'name': '%s.%s' % (name, oext),
+                    'resource': str(run),
+                    'data': content,
+                    }])
+        cls.write([run], {
+                'state': 'done',
+                'progress': 1.0,
+                })
+        notify(gettext('production_mass_balance_report'
+                '.msg_mass_balance_run_done',
+                run=run.rec_name),
+            user=run.create_uid.id)
+
+
+class ProductionMassBalanceRunProduct(ModelSQL):
+    'Production Mass Balance Run - Product'
+    __name__ = 'production.mass_balance.run-product.product'
+    run = fields.Many2One('production.mass_balance.run', 'Run',
+        required=True, ondelete='CASCADE')
+    product = fields.Many2One('product.product', 'Product', required=True,
+        ondelete='CASCADE')
+
+
+class ProductionMassBalanceRunLot(ModelSQL):
+    'Production Mass Balance Run - Lot'
+    __name__ = 'production.mass_balance.run-stock.lot'
+    run = fields.Many2One('production.mass_balance.run', 'Run',
+        required=True, ondelete='CASCADE')
+    lot = fields.Many2One('stock.lot', 'Lot', required=True,
+        ondelete='CASCADE')
+
+
+class ProductionMassBalanceLot(ModelSQL):
+    'Production Mass Balance Lot'
+    __name__ = 'production.mass_balance.lot'
+    production = fields.Many2One('production', 'Production', required=True,
+        ondelete='CASCADE')
+    company = fields.Many2One('company.company', 'Company', required=True)
+    type = fields.Selection([
+        ('input', 'Consumed'),
+        ('output', 'Produced'),
+        ], 'Type', required=True)
+    lot = fields.Many2One('stock.lot', 'Lot', required=True,
+        ondelete='CASCADE')
+    product = fields.Many2One('product.product', 'Product', required=True)
+    date = fields.Date('Date', required=True)
+    quantity = fields.Float('Quantity', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t,
+                    (t.lot, Index.Equality()),
+                    (t.type, Index.Equality()),
+                    (t.date, Index.Range())),
+                Index(t,
+                    (t.production, Index.Equality()),
+                    (t.type, Index.Equality())),
+                })
+
+    @classmethod
+    def enabled(cls):
+        "Return if the lot reports find their productions from the lots"
+        return config.getboolean('production_mass_balance', 'lots',
+            default=False)
+
+    @classmethod
+    def fill(cls, batch_size=1000):
+        """
+        Queue the computation of the lots of the running, done and cancelled
+        productions which have none, by batches of batch_size productions
 
+        It fills the lots of the productions which existed before the lots
+        option was set.
+        """
+        pool = Pool()
+        Production = pool.get('production')
+        production = Production.__table__()
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
 
-class Production(metaclass=PoolMeta):
+        if not cls.enabled():
+            return
+        cursor.execute(*production.select(production.id,
+                where=(production.state.in_(['running', 'done', 'cancelled'])
+                    & ~production.id.in_(table.select(table.production))),
+                order_by=[production.id]))
+        for sub_ids in grouped_slice([i for i, in cursor], batch_size):
+            Production.__queue__.update_mass_balance_lots(
+                Production.browse(list(sub_ids)))
+
+    @staticmethod
+    def direction_type(direction):
+        "Return the type of the lots of the requested product of direction"
+        return 'output' if direction == 'backward' else 'input'
+
+    @classmethod
+    def trace(cls, lots, direction, depth=1):
+        """
+        Return the (production, lot) ids found at each level of the chain of
+        the lots
+
+        Backward, the first level are the productions which produced the
+        lots with the lots they consumed and each next level the productions
+        which produced these lots. Forward, it follows the lots produced by
+        the productions which consumed them.
+        """
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        company_id = Transaction().context.get('company')
+
+        type_ = cls.direction_type(direction)
+        other = 'input' if type_ == 'output' else 'output'
+        levels = OrderedDict()
+        lot_ids = {l.id if isinstance(l, Model) else l for l in lots}
+        seen = set()
+        for level in range(1, depth + 1):
+            production_ids = set()
+            for sub_ids in grouped_slice(list(lot_ids)):
+                cursor.execute(*table.select(table.production,
+                        where=(reduce_ids(table.lot, sub_ids)
+                            & (table.type == type_)
+                            & (table.company == company_id))))
+                production_ids.update(p for p, in cursor)
+            production_ids -= seen
+            if not production_ids:
+                break
+            seen |= production_ids
+            nodes = []
+            for sub_ids in grouped_slice(sorted(production_ids)):
+                cursor.execute(*table.select(table.production, table.lot,
+                        where=(reduce_ids(table.production, sub_ids)
+                            & (table.type == other)),
+                        group_by=[table.production, table.lot],
+                        order_by=[table.production, table.lot]))
+                nodes.extend(cursor)
+            levels[level] = nodes
+            lot_ids = {lot_id for _, lot_id in nodes}
+        return levels
+
+
+class ProductionLot(metaclass=PoolMeta):
     __name__ = 'production'
 
+    @classmethod
+    def mass_balance_lookup(cls, requests, direction, from_date=None,
+            to_date=None, cache=None):
+        """
+        Look up the productions of the requests from the lots of the
+        productions when all of them have a lot
+        """
+        pool = Pool()
+        Lot = pool.get('production.mass_balance.lot')
+        table = Lot.__table__()
+        cursor = Transaction().connection.cursor()
+        company_id = Transaction().context.get('company')
 
-    def mass_balance_report_data(self, requested_product, direction, lot=None):
-        Uom = Pool().get('product.uom')
+        if not Lot.enabled() or not all(lot for _, lot in requests):
+            return super().mass_balance_lookup(requests, direction,
+                from_date=from_date, to_date=to_date, cache=cache)
+        cls.flush_mass_balance_lines()
 
-        digits = self.unit and self.unit.digits or 2
-        quantity = 0.0
-        total_product = 0.0
-        for move in getattr(self, 'outputs'
-                if direction == 'backward' else 'inputs'):
-            if move.state == 'cancelled':
-                continue
-            if move.product == requested_product:
-                total_product += Uom.compute_qty(move.unit, move.quantity,
-                    move.product.default_uom, False)
-                # skip moves that same product but different lot
-                if lot and lot != move.lot:
-                    continue
-                quantity += Uom.compute_qty(move.unit, move.quantity,
-                    move.product.default_uom, False)
+        where = ((table.company == company_id)
+            & (table.type == Lot.direction_type(direction))
+            & table.lot.in_([lot.id for _, lot in requests]))
+        if from_date:
+            where &= table.date >= from_date
+        if to_date:
+            where &= table.date <= to_date
+        columns = [table.production, table.product, table.lot]
+        cursor.execute(*table.select(*columns, Sum(table.quantity),
+                where=where, group_by=columns, order_by=[table.production]))
+        lines = list(cursor)
 
-        moves = {}
-        for move in getattr(self, 'inputs'
-                if direction == 'backward' else 'outputs'):
-            if move.state == 'cancelled':
-                continue
-            product = move.product
-            mqty = Uom.compute_qty(
-                move.unit, move.quantity, move.product.default_uom, False)
-            if moves.get(product):
-                moves[product] += mqty
-            else:
-                moves[product] = mqty
+        productions = cls.browse(list(OrderedDict.fromkeys(
+                    line[0] for line in lines)))
+        productions = {p.id: p for p in productions}
+        result = OrderedDict((request, OrderedDict()) for request in requests)
+        for production_id, product_id, lot_id, qty in lines:
+            production = productions[production_id]
+            for requested_product, lot in requests:
+                if requested_product.id == product_id and lot.id == lot_id:
+                    found = result[(requested_product, lot)]
+                    found[production] = found.get(production, 0.0) + qty
+        return result
 
-        res = {}
-        for product, qty in moves.items():
-            item = res.setdefault(product, {})
-            item.setdefault('balance_quantity', 0.0)
-            item.setdefault('balance_consumption', 0.0)
-            item.setdefault('balance_plan_consumption', 0.0)
-            item.setdefault('balance_difference', 0.0)
-            item.setdefault('productions', [])
+    @classmethod
+    def mass_balance_maintained(cls):
+        pool = Pool()
+        Lot = pool.get('production.mass_balance.lot')
+        return super().mass_balance_maintained() or Lot.enabled()
 
-            prod = product if direction == 'backward' else requested_product
-            balance_consumption = ((((qty * quantity) / total_product)
-                    if total_product != 0. else 0)
-                if direction == 'backward' else quantity)
+    @classmethod
+    def _update_mass_balance(cls, production_ids):
+        pool = Pool()
+        Lot = pool.get('production.mass_balance.lot')
+        super()._update_mass_balance(production_ids)
+        if Lot.enabled():
+            cls.update_mass_balance_lots(
+                cls.search([('id', 'in', production_ids)]))
 
-            balance_plan_consumption = 0.0
-            balance_difference = 0.0
-            if self.bom:
-                bom = self.bom
-                bqty = 0.0
-                for bm in bom.inputs:
-                    if bm.product == prod:
-                        bqty += Uom.compute_qty(bm.unit, bm.quantity,
-                            bm.product.default_uom, False)
-                        # To ensure that all is calcaultaed correctly, round
-                        # after UOM convert and add with the possible qty
-                        # existent. It will be the more equl to consumption
-                        # expected related with consumption.
-                        bqty = bm.unit.round(bqty)
-                factor = bom.compute_factor(self.product, bqty,
-                    self.product.default_uom)
-                balance_plan_consumption = (
-                    product.default_uom.floor(
-                        self.quantity * factor))
+    @classmethod
+    def update_mass_balance_lots(cls, productions):
+        """
+        Recompute the lots consumed and produced by the productions with
+        their quantity in the default UoM of the product on each date
 
-                if direction == 'backward':
-                    balance_difference = round(qty - balance_plan_consumption,
-                        digits)
-                else:
-                    balance_difference = round(
-                        quantity - balance_plan_consumption, digits)
-            item['balance_quantity'] = quantity
-            item['balance_consumption'] += balance_consumption
-            item['balance_plan_consumption'] += balance_plan_consumption
-            item['balance_difference'] += balance_difference
-            item['balance_quantity_uom'] = (requested_product.default_uom
-                if direction == 'backward' else product.default_uom)
-            item['balance_consumption_uom'] = prod.default_uom
-            item['balance_plan_consumption_uom'] = prod.default_uom
-            item['balance_difference_uom'] = prod.default_uom
+        The lots are stored for the running, done or cancelled productions
+        and those of the other productions are deleted.
+        """
+        pool = Pool()
+        Lot = pool.get('production.mass_balance.lot')
+        Move = pool.get('stock.move')
+        Product = pool.get('product.product')
+        move = Move.__table__()
+        cursor = Transaction().connection.cursor()
 
-            balance_difference_percent = ((
-                    (balance_consumption - balance_plan_consumption) /
-                    balance_plan_consumption) * 100
-                if balance_consumption and balance_plan_consumption else 0.0)
-            vals = {
-                'id': self.id,
-                'name': self.rec_name,
-                'product': self.product,
-                'uom': self.unit,
-                'default_uom': product.default_uom,
-                'balance_quantity': quantity,
-                'balance_consumption': balance_consumption,
-                'balance_plan_consumption': balance_plan_consumption,
-                'balance_difference': balance_difference,
-                'balance_difference_percent': balance_difference_percent,
-                'balance_quantity_uom': item['balance_quantity_uom'],
-                'balance_consumption_uom': item['balance_consumption_uom'],
-                'balance_plan_consumption_uom': item['balance_plan_consumption_uom'],
-                'balance_difference_uom': item['balance_difference_uom'],
-                }
-            item['productions'].append(vals)
+        with without_check_access():
+            Lot.delete(Lot.search([
+                        ('production', 'in', [p.id for p in productions]),
+                        ]))
 
-        return res
+        productions = cls.browse(list({p.id for p in productions
+                    if p.state in {'running', 'done', 'cancelled'}}))
+        if not productions:
+            return
+        companies = {p.id: p.company.id for p in productions}
+
+        lines = []
+        for type_, column in [
+                ('input', move.production_input),
+                ('output', move.production_output),
+                ]:
+            for sub_ids in grouped_slice(list(companies)):
+                columns = [column, move.product, move.lot, move.unit,
+                    move.effective_date]
+                cursor.execute(*move.select(*columns, Sum(move.quantity),
+                        where=(reduce_ids(column, sub_ids)
+                            & (move.state == 'done')
+                            & (move.lot != Null)),
+                        group_by=columns))
+                lines.extend((type_,) + tuple(line) for line in cursor)
+
+        products = {p.id: p for p in Product.browse(list({
+                        line[2] for line in lines}))}
+        cache = MassBalanceCache()
+        cache.load_uom_factors((line[4], products[line[2]].default_uom)
+            for line in lines)
+        quantities = OrderedDict()
+        for type_, production_id, product_id, lot_id, unit_id, date, qty in (
+                lines):
+            key = (production_id, type_, product_id, lot_id, date)
+            quantities[key] = quantities.get(key, 0.0) + cache.compute_qty(
+                unit_id, qty, products[product_id].default_uom)
+        if quantities:
+            with without_check_access():
+                Lot.create([{
+                            'production': production_id,
+                            'company': companies[production_id],
+                            'type': type_,
+                            'product': product_id,
+                            'lot': lot_id,
+                            'date': date,
+                            'quantity': quantity,
+                            } for (production_id, type_, product_id, lot_id,
+                                date), quantity in quantities.items()])
 
 
 class PrintProductionMassBalanceStart(ModelView):
@@ -151,10 +2439,42 @@ class PrintProductionMassBalanceStart(ModelView):
         states={
             'required': Bool(Eval('from_date', False)),
         })
-    direction = fields.Selection([
-        ('backward', 'Backward'),
-        ('forward', 'Forward'),
-        ], 'Direction', required=True)
+    direction = fields.Selection(DIRECTIONS, 'Direction', required=True)
+    depth = fields.Integer('Depth', required=True,
+        domain=[('depth', '>=', 1)],
+        help='Number of production levels to follow from the product.')
+    asynchronous = fields.Boolean('Run in Background',
+        help='Compute the report in the task queue and attach it to a '
+        'mass balance run.')
+    products = fields.Many2Many('product.product', None, None,
+        'Other Products',
+        states={
+            'invisible': Bool(Eval('trend')),
+            },
+        help='Add a section to the report for each of these products.')
+    output_format = fields.Selection(EXPORT_FORMATS, 'Format', required=True,
+        help='CSV, Excel and Parquet files list the summary and the '
+        'productions of each product in rows.')
+    trend = fields.Selection(TREND_BUCKETS, 'Trend',
+        help='Show the consumption of each product by period instead of by '
+        'production.')
+    deviation_limit = fields.Integer('Largest Deviations',
+        domain=[
+            If(Bool(Eval('deviation_limit')),
+                ('deviation_limit', '>=', 1), ()),
+            ],
+        help='Only show this number of productions with the largest '
+        'difference for each product.')
+    deviation_threshold = fields.Float('Deviation Threshold',
+        domain=[
+            If(Bool(Eval('deviation_threshold')),
+                ('deviation_threshold', '>=', 0), ()),
+            ],
+        help='Only show the productions with a difference larger than this '
+        'value.')
+    deviation_percentage = fields.Boolean('Deviation in Percentage',
+        help='Compare the percentage of difference instead of the '
+        'difference.')
 
     @classmethod
     def __setup__(cls):
@@ -167,12 +2487,33 @@ class PrintProductionMassBalanceStart(ModelView):
             cls.lot = fields.Many2One('stock.lot', 'Lot',
                 domain=[
                     ('product', '=', Eval('product')),
-                    ])
+                    ],
+                states={
+                    'invisible': Bool(Eval('trend')),
+                    })
+            cls.lots = fields.Many2Many('stock.lot', None, None, 'Other Lots',
+                domain=['OR',
+                    ('product', '=', Eval('product', -1)),
+                    ('product', 'in', Eval('products', [])),
+                    ],
+                states={
+                    'invisible': Bool(Eval('trend')),
+                    },
+                help='Add a section to the report for each of these lots '
+                'instead of one for all the lots of their product.')
 
     @staticmethod
     def default_direction():
         return 'backward'
 
+    @staticmethod
+    def default_depth():
+        return 1
+
+    @staticmethod
+    def default_output_format():
+        return 'html'
+
 
 class PrintProductionMassBalance(Wizard):
     'Print Production Mass Balance'
@@ -180,8 +2521,10 @@ class PrintProductionMassBalance(Wizard):
     start = StateView('production.mass_balance.start',
         'production_mass_balance_report.print_production_mass_balance_start_view_form', [
             Button('Cancel', 'end', 'tryton-cancel'),
-            Button('Print', 'print_', 'tryton-print', default=True),
+            Button('Print', 'choose', 'tryton-print', default=True),
             ])
+    choose = StateTransition()
+    enqueue = StateTransition()
     print_ = StateReport('production.mass_balance.report')
 
     def default_start(self, fields):
@@ -191,25 +2534,53 @@ class PrintProductionMassBalance(Wizard):
         if context.get('active_model'):
             Model = Pool().get(context['active_model'])
             id = Transaction().context['active_id']
+            ids = context.get('active_ids') or [id]
             if Model.__name__ == 'product.template':
-                template = Model(id)
-                if template.products:
-                    res['product'] = template.products[0].id
+                products = [p.id for t in Model.browse(ids) for p in t.products]
+                if products:
+                    res['product'] = products[0]
+                    res['products'] = products[1:]
             elif Model.__name__ == 'product.product':
                 res['product'] = id
+                res['products'] = [i for i in ids if i != id]
             elif Model.__name__ == 'stock.lot':
                 lot = Model(id)
                 res['lot'] = lot.id
                 res['product'] = lot.product.id
+                lots = [l for l in Model.browse(ids) if l != lot]
+                res['lots'] = [l.id for l in lots]
+                res['products'] = list({l.product.id for l in lots
+                        if l.product != lot.product})
         return res
 
+    def transition_choose(self):
+        if self.start.asynchronous:
+            return 'enqueue'
+        return 'print_'
+
+    def transition_enqueue(self):
+        Run = Pool().get('production.mass_balance.run')
+        run = Run.create_from_data(self.get_report_data())
+        Run.__queue__.process([run])
+        return 'end'
+
     def do_print_(self, action):
+        return action, self.get_report_data()
+
+    def get_report_data(self):
         context = Transaction().context
         data = {
             'direction': self.start.direction,
             'from_date': self.start.from_date,
             'to_date': self.start.to_date,
             'product': self.start.product.id,
+            'products': [p.id for p in self.start.products],
+            'depth': self.start.depth,
+            'output_format': self.start.output_format,
+            'trend': self.start.trend,
+            'deviation_limit': self.start.deviation_limit,
+            'deviation_threshold': self.start.deviation_threshold,
+            'deviation_percentage': self.start.deviation_percentage,
             'model': context.get('active_model'),
             'ids': context.get('active_ids') or [],
             }
@@ -219,18 +2590,27 @@ class PrintProductionMassBalance(Wizard):
             Lot = None
         if Lot:
             data['lot'] = self.start.lot.id if self.start.lot else None
-        return action, data
+            data['lots'] = [l.id for l in self.start.lots]
+        return data
 
 
 class PrintProductionMassBalanceReport(DominateReport):
     __name__ = 'production.mass_balance.report'
 
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.__rpc__['get_data'] = RPC(readonly=True)
+
     @classmethod
     def prepare(cls, data):
         pool = Pool()
         Product = pool.get('product.product')
         Company = pool.get('company.company')
         Production = pool.get('production')
+        Cache = pool.get('production.mass_balance.cache')
+        Day = pool.get('production.mass_balance.day')
+        Line = pool.get('production.mass_balance.line')
 
         try:
             Lot = pool.get('stock.lot')
@@ -245,6 +2625,20 @@ class PrintProductionMassBalanceReport(DominateReport):
         requested_product = Product(data['product'])
         direction = data['direction']
         lot = Lot(data['lot']) if data.get('lot') else None
+        if data.get('trend'):
+            # the trend is computed from the ledger lines which have no lot
+            if lot or data.get('lots'):
+                raise UserError(gettext(
+                        'production_mass_balance_report'
+                        '.msg_mass_balance_trend_lot'))
+            if set(data.get('products') or []) - {data['product']}:
+                raise UserError(gettext(
+                        'production_mass_balance_report'
+                        '.msg_mass_balance_trend_products'))
+            if not Line.enabled():
+                raise UserError(gettext(
+                        'production_mass_balance_report'
+                        '.msg_mass_balance_trend_ledger'))
 
         parameters = {}
         parameters['direction'] = direction
@@ -256,91 +2650,902 @@ class PrintProductionMassBalanceReport(DominateReport):
         parameters['base_url'] = '%s/#%s' % (http_host(),
             Transaction().database.name)
         parameters['company'] = Company(company_id)
+        diagnostics = MassBalanceDiagnostics.current()
+        if diagnostics and diagnostics.mode == 'report':
+            parameters['diagnostics'] = diagnostics
 
-        records = OrderedDict()
+        requests = cls._get_requests(data)
 
-        if direction == 'backward':
-            domain = [
-                    ('outputs.product', '=', requested_product),
-                    ('outputs.effective_date', '>=', from_date),
-                    ('outputs.effective_date', '<=', to_date),
-                    ('outputs.state', '=', 'done'),
-                    ('company', '=', company_id),
-                    ]
-            if lot:
-                domain += [('outputs.lot', '=', lot)]
+        use_cache = Cache.size() > 0
+        if use_cache:
+            with MassBalanceDiagnostics.measure('cache'):
+                key = Cache.get_key(data, company_id)
+                stamp = Cache.get_stamp(requests, direction,
+                    data.get('from_date'), data.get('to_date'),
+                    data.get('depth') or 1)
+                result = Cache.get(key, stamp)
+            if result is not None:
+                for name in ['levels', 'sections', 'trend']:
+                    if result.get(name):
+                        parameters[name] = result[name]
+                return result['records'], parameters
+
+        engine = level_engine = (data.get('engine')
+            or Production.mass_balance_engine())
+        if (engine in {'sql', 'numpy'} and not lot
+                and Line.enabled()):
+            engine = 'ledger'
+
+        deviation = MassBalanceDeviation.from_data(data)
+        if data.get('trend'):
+            records = {}
+            with MassBalanceDiagnostics.measure('trend'):
+                Production.flush_mass_balance_lines()
+                parameters['trend'] = cls._prepare_trend(requested_product,
+                    direction, data['trend'], from_date, to_date, company_id)
+        elif len(requests) > 1:
+            records = {}
+            with MassBalanceDiagnostics.measure('batch'):
+                parameters['sections'] = cls._prepare_batch(requests,
+                    direction, data.get('from_date'), data.get('to_date'),
+                    'orm' if engine == 'orm' else 'sql', deviation=deviation)
+        elif engine == 'ledger':
+            with MassBalanceDiagnostics.measure('ledger'):
+                Production.flush_mass_balance_lines()
+                records = cls._prepare_ledger(requested_product, direction,
+                    from_date, to_date, company_id, deviation=deviation)
+        elif (Day.enabled() and data.get('from_date')
+                and data.get('to_date')):
+            records = {}
+            # the results are generated while they are merged, so both are
+            # measured together
+            with MassBalanceDiagnostics.measure('compute'):
+                for res in cls._prepare_days(requested_product, direction,
+                        lot, from_date, to_date, engine, MassBalanceCache(),
+                        company_id):
+                    cls._merge_records(records, res, deviation)
+                if deviation:
+                    deviation.finish(records)
         else:
-            domain = [
-                    ('inputs.product', '=', requested_product),
-                    ('inputs.effective_date', '>=', from_date),
-                    ('inputs.effective_date', '<=', to_date),
-                    ('inputs.state', '=', 'done'),
-                    ('company', '=', company_id),
-                    ]
-            if lot:
-                domain += [('inputs.lot', '=', lot)]
+            results = cls._compute_results(requested_product, direction, lot,
+                data.get('from_date'), data.get('to_date'), engine)
+            # the results are generated while they are merged, so both are
+            # measured together
+            with MassBalanceDiagnostics.measure('compute'):
+                records = {}
+                for res in results:
+                    cls._merge_records(records, res, deviation)
+                if deviation:
+                    deviation.finish(records)
 
-        productions = Production.search(domain)
+        depth = data.get('depth') or 1
+        if depth > 1 and len(requests) == 1 and not data.get('trend'):
+            with MassBalanceDiagnostics.measure('levels'):
+                parameters['levels'] = cls._prepare_levels(requested_product,
+                    direction, lot, depth, data.get('from_date'),
+                    data.get('to_date'), deviation=deviation,
+                    engine=level_engine)
 
-        records = {}
-        for production in productions:
-            res = production.mass_balance_report_data(requested_product,
-                    direction, lot)
-
-            for key, values in res.items():
-                if not records.get(key):
-                    records.setdefault(key, {})
-                for k, v in values.items():
-                    if k.endswith('_uom'):
-                        records[key][k] = v
-                    elif k in records[key]:
-                        records[key][k] += v
-                    else:
-                        records[key][k] = v
+        if use_cache:
+            with MassBalanceDiagnostics.measure('cache'):
+                Cache.set(key, stamp, {
+                        'records': records,
+                        'levels': parameters.get('levels'),
+                        'sections': parameters.get('sections'),
+                        'trend': parameters.get('trend'),
+                        }, data, company_id)
         return records, parameters
 
     @classmethod
-    def _draw_table(cls, key, productions, parameters):
-        details_table = table(cls='table collapse multi-collapse', id=key)
-        with details_table:
+    def _compute_results(cls, requested_product, direction, lot, from_date,
+            to_date, engine):
+        """
+        Return an iterator over the mass balance of each production of the
+        product, computed by chunks or by the workers
+        """
+        pool = Pool()
+        Production = pool.get('production')
+
+        cache = MassBalanceCache()
+        with MassBalanceDiagnostics.measure('search'):
+            # only the ids are kept so the productions are not cached
+            production_ids = [p.id for p in Production.mass_balance_lookup(
+                    [(requested_product, lot)], direction, from_date, to_date,
+                    cache=cache)[(requested_product, lot)]]
+        workers = config.getint('production_mass_balance', 'workers',
+            default=1)
+        if workers > 1 and len(production_ids) > workers:
+            # the results are merged while the workers compute them
+            return cls._prepare_parallel(production_ids, requested_product,
+                direction, lot, engine, workers)
+        return cls._prepare_chunks(production_ids, requested_product,
+            direction, lot, engine, cache)
+
+    @classmethod
+    def _get_requests(cls, data):
+        """
+        Return the (product, lot) pairs requested by data
+
+        The first one is the product and lot of the report. Then each other
+        product is requested for each of its lots or for all its lots when
+        none is given.
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+        try:
+            Lot = pool.get('stock.lot')
+        except KeyError:
+            Lot = None
+
+        requested_product = Product(data['product'])
+        lot = Lot(data['lot']) if Lot and data.get('lot') else None
+        requests = [(requested_product, lot)]
+        lots = Lot.browse(data.get('lots') or []) if Lot else []
+        products = Product.browse(list(OrderedDict.fromkeys(
+                    [data['product']] + (data.get('products') or [])
+                    + [l.product.id for l in lots])))
+        for product in products:
+            product_lots = [l for l in lots if l.product == product]
+            if product == requested_product and not product_lots:
+                continue
+            for product_lot in product_lots or [None]:
+                if (product, product_lot) not in requests:
+                    requests.append((product, product_lot))
+        return requests
+
+    @classmethod
+    def _prepare_batch(cls, requests, direction, from_date, to_date, engine,
+            deviation=None):
+        """
+        Return the product, lot and records of each request searching and
+        computing the productions of all the requests at once
+        """
+        pool = Pool()
+        Production = pool.get('production')
+
+        productions = Production.mass_balance_search(requests, direction,
+            from_date, to_date)
+        if engine == 'sql':
+            results = Production.mass_balance_report_data_sql_batch(
+                productions, direction, cache=MassBalanceCache())
+        else:
+            results = {(product, lot): Production.mass_balance_results(
+                    productions[(product, lot)], product, direction, lot,
+                    engine=engine)
+                for product, lot in requests}
+
+        sections = []
+        for product, lot in requests:
+            records = {}
+            section_deviation = deviation.copy() if deviation else None
+            for res in results[(product, lot)].values():
+                cls._merge_records(records, res, section_deviation)
+            if section_deviation:
+                section_deviation.finish(records)
+            sections.append((product, lot, records))
+        return sections
+
+    @classmethod
+    def _prepare_parallel(cls, production_ids, requested_product, direction,
+            lot, engine, workers):
+        """
+        Return the mass balance of each production computed by a pool of
+        worker processes
+
+        The productions are split in contiguous partitions and the results
+        are returned in the order of the productions, so merging them gives
+        the same records as the serial computation. But the workers read the
+        committed data in their own transaction, so they do not see the
+        changes not committed by the calling transaction.
+        """
+        pool = Pool()
+        Production = pool.get('production')
+        transaction = Transaction()
+        database_name = transaction.database.name
+        context = dict(transaction.context)
+        context.pop('mass_balance_run', None)
+        context.pop('_mass_balance_diagnostics', None)
+
+        ids = production_ids
+        size = -(-len(ids) // workers)
+        partitions = [ids[i:i + size] for i in range(0, len(ids), size)]
+        # the workers are spawned as forking a process with open database
+        # connections and running threads is unsafe
+        options = {section: dict(config.items(section, raw=True))
+            for section in config.sections()}
+        with ProcessPoolExecutor(max_workers=len(partitions),
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_partition_worker,
+                initargs=(database_name, options)) as executor:
+            futures = [executor.submit(_compute_partition, database_name,
+                    transaction.user, context, partition,
+                    requested_product.id, direction,
+                    lot.id if lot else None, engine)
+                for partition in partitions]
+            done = 0
+            for partition, future in zip(partitions, futures):
+                results = load_records(future.result())
+                done += len(partition)
+                Production._mass_balance_progress(done, len(ids))
+                yield from results
+
+    @classmethod
+    def _prepare_chunks(cls, production_ids, requested_product, direction,
+            lot, engine, cache):
+        """
+        Return the mass balance of each production computed by chunks
+
+        The productions of each chunk are browsed, so their moves are read
+        at once, and the transaction cache is cleared before the next chunk
+        so the memory only depends on the size of the chunks.
+        """
+        pool = Pool()
+        Production = pool.get('production')
+        transaction = Transaction()
+        size = config.getint('production_mass_balance', 'chunk_size',
+            default=1000) or len(production_ids) or 1
+
+        for i in range(0, len(production_ids), size):
+            chunk = Production.browse(production_ids[i:i + size])
+            # the progress is reported for all the productions
+            with transaction.set_context(mass_balance_run=None):
+                results = Production.mass_balance_results(chunk,
+                    requested_product, direction, lot, cache=cache,
+                    engine=engine)
+            del chunk
+            for production in list(results):
+                yield results.pop(production)
+            # the caches are also referenced by the transaction deque
+            for records in transaction.cache.values():
+                records.clear()
+            Production._mass_balance_progress(
+                min(i + size, len(production_ids)), len(production_ids))
+
+    @classmethod
+    def _prepare_days(cls, requested_product, direction, lot, from_date,
+            to_date, engine, cache, company_id):
+        """
+        Return the mass balance of each production from the results stored
+        for each day of the dates, computing only the missing or changed days
+
+        The productions are returned in the order of their id, like the
+        lookup, so merging them gives the same records as computing all of
+        them. A production with moves on many days is returned only once.
+        """
+        pool = Pool()
+        Day = pool.get('production.mass_balance.day')
+
+        with MassBalanceDiagnostics.measure('search'):
+            days = Day.get_days(company_id, requested_product, direction, lot,
+                from_date, to_date)
+            stored = Day.get_results(company_id, requested_product,
+                direction, lot, engine, days)
+        missing = OrderedDict((date, value) for date, value in days.items()
+            if date not in stored)
+        MassBalanceDiagnostics.count('days', len(days))
+        MassBalanceDiagnostics.count('computed_days', len(missing))
+
+        results = {}
+        for day_results in stored.values():
+            results.update(day_results)
+        if missing:
+            production_ids = sorted({production_id
+                    for _, production_ids in missing.values()
+                    for production_id in production_ids})
+            computed = dict(zip(production_ids, cls._prepare_chunks(
+                        production_ids, requested_product, direction, lot,
+                        engine, cache)))
+            Day.set_results(company_id, requested_product, direction, lot,
+                engine, missing, computed)
+            results.update(computed)
+        for production_id in sorted(results):
+            yield results[production_id]
+
+    @classmethod
+    def _prepare_ledger(cls, requested_product, direction, from_date, to_date,
+            company_id, deviation=None):
+        """
+        Return the records summing the mass balance ledger lines
+
+        The threshold of the deviation is searched in the database and with
+        a limit only the lines with the largest deviation of each product are
+        read, ranked by a window.
+        """
+        pool = Pool()
+        Line = pool.get('production.mass_balance.line')
+        Product = pool.get('product.product')
+        Production = pool.get('production')
+        line = Line.__table__()
+        cursor = Transaction().connection.cursor()
+
+        # the productions are those of the lookup, with any done move of the
+        # requested product in the dates, and not only those of the date of
+        # the lines
+        lookup = Production._mass_balance_lookup_query(
+            [(requested_product, None)], direction, from_date, to_date)
+        where = ((line.company == company_id)
+            & (line.direction == direction)
+            & (line.requested_product == requested_product.id)
+            & line.production.in_(lookup.select(lookup.id)))
+        cursor.execute(*line.select(line.product,
+                Sum(line.quantity), Sum(line.consumption),
+                Sum(line.plan_consumption), Sum(line.difference),
+                where=where,
+                group_by=[line.product],
+                order_by=[line.product]))
+        records = OrderedDict()
+        for product_id, quantity, consumption, plan, difference in cursor:
+            product = Product(product_id)
+            if direction == 'backward':
+                uoms = requested_product.default_uom, product.default_uom
+            else:
+                uoms = product.default_uom, requested_product.default_uom
+            records[product] = MassBalanceRecord(*uoms, quantity,
+                consumption, plan, difference,
+                default_uom=product.default_uom)
+
+        # the same order as the lines
+        order_by = [line.production.asc, line.id.asc]
+        if deviation:
+            column = Abs(line.difference_percent if deviation.percentage
+                else line.difference)
+            if deviation.threshold is not None:
+                where &= column > deviation.threshold
+        if deviation and deviation.limit:
+            query = line.select(line.id, line.production,
+                RowNumber(window=Window([line.product],
+                        order_by=[column.desc] + order_by)).as_('rank'),
+                where=where)
+            query = query.select(query.id,
+                where=query.rank <= deviation.limit,
+                order_by=[query.production.asc, query.id.asc])
+        else:
+            query = line.select(line.id, where=where, order_by=order_by)
+        cursor.execute(*query)
+        for line in Line.browse([i for i, in cursor]):
+            row = line.get_mass_balance_row()
+            if deviation:
+                deviation.push(line.product, [row])
+            else:
+                records[line.product].rows.append(row)
+        if deviation:
+            deviation.finish(records)
+        return records
+
+    @classmethod
+    def _prepare_trend(cls, requested_product, direction, bucket, from_date,
+            to_date, company_id):
+        """
+        Return the product, UoM and the consumption, plan consumption and
+        difference of each period of the product from the mass balance lines
+        grouped by the truncated date in a single query
+
+        The weeks are summed from the days as SQLite does not truncate to
+        the week, so they start on Monday on all the databases.
+        """
+        pool = Pool()
+        Line = pool.get('production.mass_balance.line')
+        Product = pool.get('product.product')
+        line = Line.__table__()
+        cursor = Transaction().connection.cursor()
+
+        # the period is grouped from a subquery as the parameter of the
+        # truncation is not the same in the columns and the group by
+        query = line.select(line.product,
+            DateTrunc('day' if bucket == 'week' else bucket,
+                line.date).as_('period'),
+            line.consumption, line.plan_consumption, line.difference,
+            where=((line.company == company_id)
+                & (line.direction == direction)
+                & (line.requested_product == requested_product.id)
+                & (line.date >= from_date)
+                & (line.date <= to_date)))
+        cursor.execute(*query.select(query.product, query.period,
+                Sum(query.consumption), Sum(query.plan_consumption),
+                Sum(query.difference),
+                group_by=[query.product, query.period],
+                order_by=[query.product, query.period]))
+
+        trend = OrderedDict()
+        for product_id, period, consumption, plan, difference in cursor:
+            if isinstance(period, str):
+                period = datetime.fromisoformat(period)
+            if isinstance(period, datetime):
+                period = period.date()
+            if bucket == 'week':
+                period -= timedelta(days=period.weekday())
+            periods = trend.setdefault(product_id, [])
+            if periods and periods[-1][0] == period:
+                _, *values = periods[-1]
+                consumption, plan, difference = (a + b for a, b in zip(
+                        values, [consumption, plan, difference]))
+                periods[-1] = (period, consumption, plan, difference)
+            else:
+                periods.append((period, consumption, plan, difference))
+        result = []
+        for product in Product.browse(list(trend)):
+            uom = (product.default_uom if direction == 'backward'
+                else requested_product.default_uom)
+            result.append((product, uom, trend[product.id]))
+        return result
+
+    @classmethod
+    def _prepare_levels(cls, requested_product, direction, lot, depth,
+            from_date, to_date, deviation=None, engine=None):
+        """
+        Return the records of each level of the genealogy after the first
+
+        The productions of each level are computed with the engine like
+        those of the first level.
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+        Production = pool.get('production')
+        try:
+            Lot = pool.get('stock.lot')
+        except KeyError:
+            Lot = None
+
+        tree = Production.mass_balance_genealogy(requested_product,
+            direction, lot, depth, from_date, to_date)
+        cache = MassBalanceCache()
+        # the mass balance of a node is the same wherever it appears
+        subtrees = {}
+        levels = []
+        for level, nodes in tree.items():
+            if level == 1:
+                continue
+            pending = OrderedDict()
+            for node in nodes:
+                if node not in subtrees:
+                    production_id, product_id, lot_id = node
+                    pending.setdefault((product_id, lot_id), []).append(
+                        production_id)
+            for (product_id, lot_id), production_ids in pending.items():
+                # the progress of a run is only reported by the first level
+                with Transaction().set_context(mass_balance_run=None):
+                    results = Production.mass_balance_results(
+                        Production.browse(production_ids),
+                        Product(product_id), direction,
+                        Lot(lot_id) if Lot and lot_id else None, cache=cache,
+                        engine=engine)
+                for production, res in results.items():
+                    subtrees[(production.id, product_id, lot_id)] = res
+
+            records = {}
+            level_deviation = deviation.copy() if deviation else None
+            for node in nodes:
+                cls._merge_records(records, subtrees[node], level_deviation)
+            if level_deviation:
+                level_deviation.finish(records)
+            levels.append((level, records))
+        return levels
+
+    @classmethod
+    def get_data(cls, data, fields=None, product=None, after=None,
+            limit=None):
+        """
+        Return the result of the report data as JSON values with ids instead
+        of records
+
+        fields is the list of the parts ('summary', 'details' and 'trend')
+        and of the columns to return, all of them when none is given. The
+        details are the rows of the productions ordered by group, product and
+        production. They can be filtered by product id and paginated by
+        passing the 'next' key of the previous page as after. The report is
+        prepared again for each page, so it is only cheap when the result is
+        in the cache.
+        """
+        cls.check_data_access(data)
+        records, parameters = cls.prepare(data)
+        fields = set(fields or [])
+        parts = {'summary', 'details', 'trend'} & fields or {
+            'summary', 'details', 'trend'}
+        columns = [c for c in cls._data_columns() if c in fields]
+        if not columns:
+            columns = cls._data_columns()
+        lot = parameters.get('lot')
+        result = {
+            'company': parameters['company'].id,
+            'requested_product': parameters['requested_product'].id,
+            'lot': lot.id if lot else None,
+            'direction': parameters['direction'],
+            'from_date': data.get('from_date'),
+            'to_date': data.get('to_date'),
+            }
+        groups = list(cls._export_groups(records, parameters))
+        if 'summary' in parts:
+            result['summary'] = summary = []
+            for requested_product, lot, level, group in groups:
+                for group_product, record in group.items():
+                    values = {
+                        'requested_product': requested_product.id,
+                        'lot': lot.id if lot else None,
+                        'level': level,
+                        'product': group_product.id,
+                        'quantity_uom': record.quantity_uom.id,
+                        'uom': record.uom.id,
+                        }
+                    values.update((c, getattr(record, c)) for c in columns
+                        if c != 'name')
+                    summary.append(values)
+        if 'details' in parts:
+            result['details'], result['next'] = cls._data_details(groups,
+                columns, product, after, limit)
+        if 'trend' in parts and parameters.get('trend'):
+            result['trend'] = [{
+                    'product': trend_product.id,
+                    'uom': uom.id,
+                    'periods': [{
+                            'period': period,
+                            'consumption': consumption,
+                            'plan_consumption': plan,
+                            'difference': difference,
+                            } for period, consumption, plan, difference
+                        in periods],
+                    } for trend_product, uom, periods in parameters['trend']]
+        return result
+
+    @classmethod
+    def _data_columns(cls):
+        "Return the columns of the results returned by get_data"
+        return ['name', 'quantity', 'consumption', 'plan_consumption',
+            'difference', 'difference_percent']
+
+    @classmethod
+    def _data_details(cls, groups, columns, product=None, after=None,
+            limit=None):
+        """
+        Return a page of the production rows of the groups and the key of
+        its last row when there are more rows
+
+        The key of a row is the index of its group, the ids of its product
+        and production and its position among the rows of the same
+        production, so the pages are stable.
+        """
+        after = tuple(after) if after else None
+        details, last = [], None
+        for index, (requested_product, lot, level, group) in enumerate(
+                groups):
+            if after and index < after[0]:
+                continue
+            products = sorted((p for p in group
+                    if product is None or p.id == product),
+                key=lambda p: p.id)
+            for group_product in products:
+                if after and (index, group_product.id) < after[:2]:
+                    continue
+                positions = {}
+                keys = []
+                for row in group[group_product].rows:
+                    position = positions[row.id] = (
+                        positions.get(row.id, -1) + 1)
+                    keys.append(((index, group_product.id, row.id, position),
+                            row))
+                keys.sort(key=lambda k: k[0])
+                for key, row in keys:
+                    if after and key <= after:
+                        continue
+                    if limit and len(details) >= limit:
+                        return details, list(last)
+                    values = {
+                        'requested_product': requested_product.id,
+                        'lot': lot.id if lot else None,
+                        'level': level,
+                        'product': group_product.id,
+                        'production': row.id,
+                        }
+                    values.update((c, getattr(row, c)) for c in columns)
+                    details.append(values)
+                    last = key
+        return details, None
+
+    @classmethod
+    def _merge_records(cls, records, res, deviation=None):
+        """
+        Add the mass balance of a production to the report records
+
+        With a deviation, the rows are kept in its heaps and they must be set
+        back with its finish method once all the productions are merged.
+        """
+        for product, record in res.items():
+            if isinstance(record, dict):
+                # overrides of mass_balance_report_data may still return the
+                # dictionaries formerly used
+                record = MassBalanceRecord.from_dict(product, record)
+            if product in records:
+                records[product].merge(record)
+            else:
+                # the results may be shared so they are not modified
+                records[product] = record.copy()
+            if deviation:
+                deviation.filter(product, records[product])
+
+    @classmethod
+    def _draw_table_head(cls):
+        head = thead()
+        with head:
+            with tr():
+                th(_('Production'), scope='col')
+                th(_('Quantity'), scope='col')
+                th(_('Consumption'), scope='col')
+                th(_('Plan Consumption'), scope='col')
+                th(_('Difference'), scope='col')
+                th(_('% DIFF'), scope='col')
+        return head
+
+    @classmethod
+    def _draw_summary_head(cls):
+        head = thead()
+        with head:
+            with tr():
+                th(_('Product'), scope='col', width='50%')
+                th(_('Quantity'), scope='col', width='10%')
+                th(_('Consumption'), scope='col', width='10%')
+                th(_('Plan Consumption'), scope='col', width='10%')
+                th(_('Difference'), scope='col', width='10%')
+                th(_('% DIFF'), scope='col', width='10%')
+        return head
+
+    @classmethod
+    def _draw_trend(cls, trend):
+        trend_table = table(cls='table', id='trend')
+        with trend_table:
             with thead():
                 with tr():
-                    th(_('Production'), scope='col')
-                    th(_('Quantity'), scope='col')
-                    th(_('Consumption'), scope='col')
-                    th(_('Plan Consumption'), scope='col')
-                    th(_('Difference'), scope='col')
-                    th(_('% DIFF'), scope='col')
+                    th(_('Product'), scope='col', width='30%')
+                    th(_('Period'), scope='col', width='20%')
+                    th(_('Consumption'), scope='col', width='15%')
+                    th(_('Plan Consumption'), scope='col', width='15%')
+                    th(_('Difference'), scope='col', width='10%')
+                    th(_('% DIFF'), scope='col', width='10%')
             with tbody():
-                for production in productions:
-                    with tr():
-                        with td(width='50%'):
-                            a(production['name'],
-                                href='%s/model/production/%s;name="%s"' % (
-                                    parameters['base_url'],
-                                    production['id'],
-                                    production['name']))
-                        td('%s %s' % (
-                            html_render(production['balance_quantity'], digits=4),
-                            production['balance_quantity_uom'].symbol),
-                            width='10%')
-                        td('%s %s' % (
-                            html_render(production['balance_consumption'], digits=4),
-                            production['balance_consumption_uom'].symbol),
-                            width='10%')
-                        td('%s %s' % (
-                            html_render(production['balance_plan_consumption'],
-                                digits=4),
-                            production['balance_plan_consumption_uom'].symbol),
-                            width='10%')
-                        td('%s %s' % (
-                            html_render(production['balance_difference'], digits=4),
-                            production['balance_difference_uom'].symbol),
-                            width='10%')
-                        td('%s %%' % html_render(
-                            production['balance_difference_percent']),
-                            width='10%')
-        return details_table
+                for product, uom, periods in trend:
+                    for n, (period, consumption, plan, difference) in (
+                            enumerate(periods)):
+                        with tr():
+                            td(product.rec_name if not n else '')
+                            td(html_render(period))
+                            td('%s %s' % (html_render(consumption, digits=4),
+                                    uom.symbol))
+                            td('%s %s' % (html_render(plan, digits=4),
+                                    uom.symbol))
+                            td('%s %s' % (html_render(difference, digits=4),
+                                    uom.symbol))
+                            percent = (((consumption - plan) / plan) * 100
+                                if plan else 0.0)
+                            td('%s %%' % html_render(percent, digits=2))
+        return trend_table
+
+    @classmethod
+    def _export_columns(cls):
+        "Return the name and type of the columns of the exported rows"
+        return [
+            ('requested_product', 'string'),
+            ('lot', 'string'),
+            ('level', 'int'),
+            ('product', 'string'),
+            ('production', 'string'),
+            ('quantity', 'float'),
+            ('quantity_uom', 'string'),
+            ('consumption', 'float'),
+            ('consumption_uom', 'string'),
+            ('plan_consumption', 'float'),
+            ('plan_consumption_uom', 'string'),
+            ('difference', 'float'),
+            ('difference_uom', 'string'),
+            ('difference_percent', 'float'),
+            ]
+
+    @classmethod
+    def _export_groups(cls, records, parameters):
+        "Yield the requested product, lot, level and records of the report"
+        if parameters.get('sections'):
+            for product, lot, section in parameters['sections']:
+                yield product, lot, 1, section
+        else:
+            yield (parameters['requested_product'], parameters.get('lot'), 1,
+                records)
+        for level, level_records in parameters.get('levels', []):
+            yield (parameters['requested_product'], parameters.get('lot'),
+                level, level_records)
+
+    @classmethod
+    def _export_row(cls, product, record, row=None):
+        """
+        Return the values of the row of a production of the record, or of
+        the summary of the product without row
+        """
+        values = row or record
+        quantity_symbol = record.quantity_uom.symbol
+        symbol = record.uom.symbol
+        return (product.rec_name, row.name if row else None,
+            values.quantity, quantity_symbol,
+            values.consumption, symbol,
+            values.plan_consumption, symbol,
+            values.difference, symbol,
+            values.difference_percent)
+
+    @classmethod
+    def _export_rows(cls, records, parameters):
+        """
+        Yield a row for each production of each product, which has the name
+        of the production set, followed by a row for the summary of each
+        product
+
+        In trend mode, there is a row for each period of each product with
+        the start date of the period instead of the production.
+        """
+        requested_product = parameters['requested_product']
+        for product, uom, periods in parameters.get('trend') or []:
+            for period, consumption, plan, difference in periods:
+                percent = ((consumption - plan) / plan) * 100 if plan else 0.0
+                yield (requested_product.rec_name, None, 1,
+                    product.rec_name, period.isoformat(),
+                    None, None,
+                    consumption, uom.symbol,
+                    plan, uom.symbol,
+                    difference, uom.symbol,
+                    percent)
+        for requested_product, lot, level, group in cls._export_groups(
+                records, parameters):
+            head = (requested_product.rec_name, lot.number if lot else None,
+                level)
+            for product, record in group.items():
+                for row in record.rows:
+                    yield head + cls._export_row(product, record, row)
+            for product, record in group.items():
+                yield head + cls._export_row(product, record)
+
+    @classmethod
+    def _export_computed_rows(cls, requested_product, lot, results):
+        """
+        Yield the rows of the productions of results while they are computed
+        followed by a row for the summary of each product
+
+        Only the sums of each product are kept, not its rows.
+        """
+        head = (requested_product.rec_name, lot.number if lot else None, 1)
+        records = {}
+        for res in results:
+            for product, record in res.items():
+                if isinstance(record, dict):
+                    record = MassBalanceRecord.from_dict(product, record)
+                for row in record.rows:
+                    yield head + cls._export_row(product, record, row)
+                summary = records.get(product)
+                if summary is None:
+                    summary = records[product] = MassBalanceRecord(
+                        record.quantity_uom, record.uom,
+                        default_uom=record.default_uom)
+                summary.merge(MassBalanceRecord(record.quantity_uom,
+                        record.uom, record.quantity, record.consumption,
+                        record.plan_consumption, record.difference,
+                        default_uom=record.default_uom))
+        for product, record in records.items():
+            yield head + cls._export_row(product, record)
+
+    @classmethod
+    def _export_engine(cls, data):
+        """
+        Return the engine computing the productions if the rows of the export
+        can be written while they are computed, otherwise None
+
+        It is the case of the reports of a product which are not cached and
+        have no trend, levels, deviation, ledger nor results of each day.
+        """
+        pool = Pool()
+        Production = pool.get('production')
+        Cache = pool.get('production.mass_balance.cache')
+        Day = pool.get('production.mass_balance.day')
+        Line = pool.get('production.mass_balance.line')
+
+        engine = data.get('engine') or Production.mass_balance_engine()
+        if (data.get('trend')
+                or Cache.size() > 0
+                or (data.get('depth') or 1) > 1
+                or len(cls._get_requests(data)) > 1
+                or MassBalanceDeviation.from_data(data)
+                or (engine in {'sql', 'numpy'} and not data.get('lot')
+                    and Line.enabled())
+                or (Day.enabled() and data.get('from_date')
+                    and data.get('to_date'))):
+            return None
+        return engine
+
+    @classmethod
+    def export(cls, records, parameters, output_format):
+        """
+        Return the extension and the content of the report rows written in
+        output_format
+        """
+        return cls._export_file(cls._export_rows(records, parameters),
+            output_format)
+
+    @classmethod
+    def export_computed(cls, data, engine, output_format):
+        """
+        Return the extension and the content of the rows of the productions
+        of data written in output_format while they are computed
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+        try:
+            Lot = pool.get('stock.lot')
+        except KeyError:
+            Lot = None
+
+        requested_product = Product(data['product'])
+        lot = Lot(data['lot']) if Lot and data.get('lot') else None
+        results = cls._compute_results(requested_product, data['direction'],
+            lot, data.get('from_date'), data.get('to_date'), engine)
+        return cls._export_file(
+            cls._export_computed_rows(requested_product, lot, results),
+            output_format)
+
+    @classmethod
+    def _export_file(cls, rows, output_format):
+        """
+        Return the extension and the content of the rows written in
+        output_format
+
+        The rows are written one by one to a temporary file, so no document
+        of the whole report is built in memory. But the report returns its
+        content, so the file is read back at once.
+        """
+        if output_format not in dict(EXPORT_FORMATS) or output_format == 'html':
+            raise UserError(gettext('production_mass_balance_report'
+                    '.msg_mass_balance_export_invalid_format',
+                    format=output_format))
+        with tempfile.TemporaryFile() as file:
+            getattr(cls, '_export_%s' % output_format)(file, rows)
+            file.seek(0)
+            return output_format, file.read()
+
+    @classmethod
+    def _export_csv(cls, file, rows):
+        stream = io.TextIOWrapper(file, encoding='utf-8', newline='')
+        writer = csv.writer(stream)
+        writer.writerow([name for name, _ in cls._export_columns()])
+        writer.writerows(rows)
+        stream.flush()
+        stream.detach()
+
+    @classmethod
+    def _export_xlsx(cls, file, rows):
+        if openpyxl is None:
+            raise UserError(gettext('production_mass_balance_report'
+                    '.msg_mass_balance_export_missing_library',
+                    format='Excel', library='openpyxl'))
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        sheet.append([name for name, _ in cls._export_columns()])
+        for row in rows:
+            sheet.append(row)
+        workbook.save(file)
+
+    @classmethod
+    def _export_parquet(cls, file, rows, batch_size=10000):
+        if pyarrow is None:
+            raise UserError(gettext('production_mass_balance_report'
+                    '.msg_mass_balance_export_missing_library',
+                    format='Parquet', library='pyarrow'))
+        types = {
+            'string': pyarrow.string(),
+            'int': pyarrow.int64(),
+            'float': pyarrow.float64(),
+            }
+        columns = cls._export_columns()
+        schema = pyarrow.schema([(name, types[type_])
+                for name, type_ in columns])
+        with pyarrow.parquet.ParquetWriter(file, schema) as writer:
+            while True:
+                batch = list(islice(rows, batch_size))
+                if not batch:
+                    break
+                writer.write_batch(pyarrow.record_batch(
+                        [list(column) for column in zip(*batch)],
+                        schema=schema))
 
     @classmethod
     def css(cls, action, data, records):
@@ -355,139 +3560,313 @@ class PrintProductionMassBalanceReport(DominateReport):
 
     @classmethod
     def body(cls, action, data, records):
-        parameters = data['parameters']
-        wrapper = div()
-        with wrapper:
-            with table(cls='table'):
-                with tbody():
-                    with tr():
-                        with td():
-                            h1(_('Mass Balance'))
-                        with td(align='right'):
-                            company = parameters['company']
-                            a(company.rec_name,
-                                href=parameters['base_url'],
-                                alt=company.rec_name)
-                            button(_('Expand All'),
-                                type='button',
-                                cls='btn tn-outline-light btn-sm',
-                                onclick='expand()')
-                    with tr():
-                        with td(colspan='2'):
-                            strong(_('Efficiency Product Type:'))
-                            raw(' %s' % (
-                                _('Backward')
-                                if parameters['direction'] == 'backward'
-                                else _('Forward')))
-                    with tr():
-                        with td():
-                            strong(_('Product:'))
-                            raw(' %s' % parameters['requested_product'].rec_name)
-                        with td():
-                            if parameters.get('lot'):
-                                strong(_('Lot:'))
-                                raw(' %s' % parameters['lot'].number)
-                    with tr():
-                        with td(colspan='2'):
-                            strong(_('Quantity:'))
-                            raw(' %s' % _(
-                                'quantity produced including all outgoing moves in production'))
-                            raw('<br>')
-                            strong(_('Consumption:'))
-                            raw(' %s' % _(
-                                'amount of product consumed per production'))
-                            raw('<br>')
-                            strong(_('Plan Consumption:'))
-                            raw(' %s' % _(
-                                "calculated consumption out of production's quantity field (initial production quantity)"))
-                    if parameters.get('show_date'):
-                        with tr():
-                            with td():
-                                strong(_('From Date:'))
-                                raw(' %s' % html_render(parameters['from_date']))
-                            with td():
-                                strong(_('To Date:'))
-                                raw(' %s' % html_render(parameters['to_date']))
-                    with tr():
-                        with td(colspan='2'):
-                            with table(cls='table', id='detail'):
-                                with thead():
-                                    with tr():
-                                        th(_('Product'), scope='col', width='50%')
-                                        th(_('Quantity'), scope='col', width='10%')
-                                        th(_('Consumption'), scope='col', width='10%')
-                                        th(_('Plan Consumption'), scope='col', width='10%')
-                                        th(_('Difference'), scope='col', width='10%')
-                                        th(_('% DIFF'), scope='col', width='10%')
-                                with tbody():
-                                    for product, values in data['records'].items():
-                                        key = 'product-%s' % product.id
-                                        with tr():
-                                            with td(width='50%'):
-                                                with a(href='#%s' % key,
-                                                    cls='',
-                                                    **{
-                                                        'data-toggle': 'collapse',
-                                                        'role': 'button',
-                                                        'aria-expanded': 'false',
-                                                        'aria-controls': key,
-                                                    }):
-                                                    i(cls='fas fa-angle-double-right')
-                                                    raw(' %s' % product.rec_name)
-                                            td('%s %s' % (
-                                                html_render(values['balance_quantity'],
-                                                    digits=4),
-                                                values['balance_quantity_uom'].symbol),
-                                                width='10%')
-                                            td('%s %s' % (
-                                                html_render(values['balance_consumption'],
-                                                    digits=4),
-                                                values['balance_consumption_uom'].symbol),
-                                                width='10%')
-                                            td('%s %s' % (
-                                                html_render(values['balance_plan_consumption'],
-                                                    digits=4),
-                                                values['balance_plan_consumption_uom'].symbol),
-                                                width='10%')
-                                            td('%s %s' % (
-                                                html_render(values['balance_difference'],
-                                                    digits=4),
-                                                values['balance_difference_uom'].symbol),
-                                                width='10%')
-                                            plan = values['balance_plan_consumption']
-                                            if plan:
-                                                percent = ((values['balance_consumption']
-                                                    - plan) / plan) * 100
-                                            else:
-                                                percent = 0.0
-                                            td('%s %%' % html_render(percent, digits=2),
-                                                width='10%')
-                                        with tr():
-                                            with td(colspan='6') as detail_cell:
-                                                detail_cell.add(cls._draw_table(
-                                                    key,
-                                                    values['productions'],
-                                                    parameters))
+        if data.get('body_marker'):
+            # the document around the body for stream
+            return raw(data['body_marker'])
+        # the body is written by the same templates as the streamed one
+        return raw(''.join(cls._stream_body(data['records'],
+                    data['parameters'])))
+
+    @classmethod
+    def _body_rows(cls, records, parameters):
+        """
+        Yield the rows of the table of the body
+
+        The summaries are yielded as a tuple with their records and prefix
+        so they can be drawn or streamed.
+        """
+        row = tr()
+        with row:
+            with td():
+                h1(_('Mass Balance'))
+            with td(align='right'):
+                company = parameters['company']
+                a(company.rec_name,
+                    href=parameters['base_url'],
+                    alt=company.rec_name)
+                button(_('Expand All'),
+                    type='button',
+                    cls='btn tn-outline-light btn-sm',
+                    onclick='expand()')
+        yield row
+        row = tr()
+        with row:
+            with td(colspan='2'):
+                strong(_('Efficiency Product Type:'))
+                raw(' %s' % (
+                    _('Backward')
+                    if parameters['direction'] == 'backward'
+                    else _('Forward')))
+        yield row
+        if not parameters.get('sections'):
+            row = tr()
+            with row:
+                with td():
+                    strong(_('Product:'))
+                    raw(' %s' % parameters['requested_product'].rec_name)
+                with td():
+                    if parameters.get('lot'):
+                        strong(_('Lot:'))
+                        raw(' %s' % parameters['lot'].number)
+            yield row
+        row = tr()
+        with row:
+            with td(colspan='2'):
+                strong(_('Quantity:'))
+                raw(' %s' % _(
+                    'quantity produced including all outgoing moves in production'))
+                raw('<br>')
+                strong(_('Consumption:'))
+                raw(' %s' % _(
+                    'amount of product consumed per production'))
+                raw('<br>')
+                strong(_('Plan Consumption:'))
+                raw(' %s' % _(
+                    "calculated consumption out of production's quantity field (initial production quantity)"))
+        yield row
+        if parameters.get('show_date'):
+            row = tr()
+            with row:
+                with td():
+                    strong(_('From Date:'))
+                    raw(' %s' % html_render(parameters['from_date']))
+                with td():
+                    strong(_('To Date:'))
+                    raw(' %s' % html_render(parameters['to_date']))
+            yield row
+        if not parameters.get('sections') and not parameters.get('trend'):
+            yield records, 'product'
+        if parameters.get('trend'):
+            yield tr(td(cls._draw_trend(parameters['trend']), colspan='2'))
+        for n, (product, lot, section) in enumerate(
+                parameters.get('sections', [])):
+            row = tr()
+            with row:
+                with td():
+                    strong(_('Product:'))
+                    raw(' %s' % product.rec_name)
+                with td():
+                    if lot:
+                        strong(_('Lot:'))
+                        raw(' %s' % lot.number)
+            yield row
+            yield section, 'section-%s-product' % n
+        for level, level_records in parameters.get('levels', []):
+            row = tr()
+            with row:
+                with td(colspan='2'):
+                    strong(_('Level:'))
+                    raw(' %s' % level)
+            yield row
+            yield level_records, 'level-%s-product' % level
+
+    @classmethod
+    def _body_footer(cls, parameters):
+        "Return the elements of the body after its table"
+        elements = [
             script(src='https://code.jquery.com/jquery-3.3.1.slim.min.js',
                 integrity='sha384-q8i/X+965DzO0rT7abK41JStQIAqVgRVzpbzo5smXKp4YfRvH+8abtTE1Pi6jizo',
-                crossorigin='anonymous')
+                crossorigin='anonymous'),
             script(src='https://cdnjs.cloudflare.com/ajax/libs/popper.js/1.14.7/umd/popper.min.js',
                 integrity='sha384-UO2eT0CpHqdSJQ6hJty5KVphtPhzWj9WO1clHTMGa3JDZwrnQq4sF86dIHNDz0W1',
-                crossorigin='anonymous')
+                crossorigin='anonymous'),
             script(src='https://stackpath.bootstrapcdn.com/bootstrap/4.3.1/js/bootstrap.min.js',
                 integrity='sha384-JjSmVgyd0p3pXB1rRibZUAYoIIy6OrQ6VrjIEaFf/nJGzIxFDsf4x0xIM+B07jRM',
-                crossorigin='anonymous')
-            script(raw("""
+                crossorigin='anonymous'),
+            ]
+        if parameters.get('diagnostics'):
+            elements.append(div(
+                    pre('\n'.join(parameters['diagnostics'].lines())),
+                    id='diagnostics', style='display: none'))
+        elements.append(script(raw("""
 function expand() {
   $('.collapse').collapse('show');
 }
-"""), type='text/javascript', charset='utf-8')
-        return wrapper
+"""), type='text/javascript', charset='utf-8'))
+        return elements
+
+    @classmethod
+    def stream(cls, ids, data):
+        """
+        Yield the chunks of the HTML document of the report
+
+        The document around the body is rendered by DominateReport, so it is
+        the same as the one of execute, and the rows of the summaries and of
+        the productions are written with templates instead of building the
+        tree of the whole document.
+        """
+        marker = '<!--mass-balance-body-->'
+        _, content, _, _ = super().execute(ids, dict(data,
+                records={}, body_marker=marker))
+        if isinstance(content, bytes):
+            content = content.decode('utf-8')
+        head, tail = content.split(marker)
+        yield head
+        yield from cls._stream_body(data['records'], data['parameters'])
+        yield tail
+
+    @classmethod
+    def _stream_body(cls, records, parameters):
+        "Yield the chunks of the body of the report"
+        yield '<div><table class="table"><tbody>'
+        for row in cls._body_rows(records, parameters):
+            if isinstance(row, tuple):
+                summary_records, prefix = row
+                yield '<tr><td colspan="2">'
+                yield from cls._stream_summary(summary_records, parameters,
+                    prefix)
+                yield '</td></tr>'
+            else:
+                yield row.render()
+        yield '</tbody></table>'
+        for element in cls._body_footer(parameters):
+            yield element.render()
+        yield '</div>'
+
+    @classmethod
+    def _stream_cells(cls, values, symbols, digits=4):
+        cells = []
+        for value, symbol in zip(values, symbols):
+            cells.append('<td width="10%%">%s %s</td>' % (
+                    html.escape(html_render(value, digits=digits), False),
+                    html.escape(symbol, False)))
+        return ''.join(cells)
+
+    @classmethod
+    def _stream_summary(cls, records, parameters, prefix):
+        yield '<table class="table" id="detail">'
+        yield cls._draw_summary_head().render()
+        yield '<tbody>'
+        for product, record in records.items():
+            key = '%s-%s' % (prefix, product.id)
+            yield ('<tr><td width="50%%"><a href="#%(key)s" class="" '
+                'data-toggle="collapse" role="button" aria-expanded="false" '
+                'aria-controls="%(key)s">'
+                '<i class="fas fa-angle-double-right"></i> %(name)s</a></td>'
+                % {
+                    'key': key,
+                    'name': product.rec_name,
+                    })
+            yield cls._stream_cells(
+                [record.quantity, record.consumption, record.plan_consumption,
+                    record.difference],
+                [record.quantity_uom.symbol] + [record.uom.symbol] * 3)
+            yield cls._stream_cells([record.difference_percent], ['%'],
+                digits=2)
+            yield '</tr><tr><td colspan="6">'
+            yield from cls._stream_table(key, record, parameters)
+            yield '</td></tr>'
+        yield '</tbody></table>'
+
+    @classmethod
+    def _stream_table(cls, key, record, parameters):
+        yield '<table class="table collapse multi-collapse" id="%s">' % key
+        yield cls._draw_table_head().render()
+        yield '<tbody>'
+        symbols = [record.quantity_uom.symbol] + [record.uom.symbol] * 3
+        for row in record.rows:
+            name = html.escape(row.name, False)
+            yield ('<tr><td width="50%%"><a href="%s">%s</a></td>' % (
+                    html.escape('%s/model/production/%s;name="%s"' % (
+                            parameters['base_url'], row.id, row.name)),
+                    name))
+            yield cls._stream_cells([row.quantity, row.consumption,
+                    row.plan_consumption, row.difference], symbols)
+            yield '<td width="10%%">%s %%</td></tr>' % html.escape(
+                html_render(row.difference_percent), False)
+        yield '</tbody></table>'
+
+    @classmethod
+    def _stream_rows(cls, records, parameters):
+        "Return if the report has enough rows to be streamed"
+        limit = config.getint('production_mass_balance', 'stream_rows',
+            default=10000)
+        if not limit:
+            return False
+        groups = [records]
+        groups.extend(section for _, _, section in
+            parameters.get('sections', []))
+        groups.extend(level for _, level in parameters.get('levels', []))
+        return sum(len(record.rows) for group in groups
+            for record in group.values()) > limit
 
     @classmethod
     def execute(cls, ids, data):
-        records, parameters = cls.prepare(data)
-        return super().execute(ids, {
+        mode = MassBalanceDiagnostics.get_mode()
+        if not mode:
+            return cls._execute(ids, data)
+        diagnostics = MassBalanceDiagnostics(mode)
+        with Transaction().set_context(
+                _mass_balance_diagnostics=diagnostics):
+            try:
+                with MassBalanceDiagnostics.measure('execute'):
+                    return cls._execute(ids, data)
+            finally:
+                diagnostics.log('Mass balance of product %s (%s)' % (
+                        data.get('product'), data.get('direction')))
+
+    @classmethod
+    def get_action_report(cls, data):
+        "Return the action of the report for data"
+        pool = Pool()
+        ActionReport = pool.get('ir.action.report')
+        if data.get('action_id') is None:
+            action_report, = ActionReport.search([
+                    ('report_name', '=', cls.__name__),
+                    ], limit=1)
+        else:
+            action_report = ActionReport(data['action_id'])
+        return action_report
+
+    @classmethod
+    def check_data_access(cls, data):
+        "Check the access to the report for data like execute does"
+        action_report = cls.get_action_report(data)
+        cls.check_access(action_report,
+            action_report.model or data.get('model'),
+            list(map(int, data.get('ids') or [])))
+
+    @classmethod
+    def _execute(cls, ids, data):
+        output_format = data.get('output_format') or 'html'
+        # the exports and the streamed HTML do not call execute which checks
+        # the access, and it is checked before computing the report
+        cls.check_data_access(data)
+        action_report = cls.get_action_report(data)
+        if output_format != 'html':
+            engine = cls._export_engine(data)
+            if engine:
+                # the rows are written while the productions are computed
+                with MassBalanceDiagnostics.measure('export'):
+                    oext, content = cls.export_computed(data, engine,
+                        output_format)
+            else:
+                with MassBalanceDiagnostics.measure('prepare'):
+                    records, parameters = cls.prepare(data)
+                with MassBalanceDiagnostics.measure('export'):
+                    oext, content = cls.export(records, parameters,
+                        output_format)
+            return oext, content, action_report.direct_print, action_report.name
+        with MassBalanceDiagnostics.measure('prepare'):
+            records, parameters = cls.prepare(data)
+        html_data = cls._html_data(data, records, parameters)
+        if cls._stream_rows(records, parameters):
+            with MassBalanceDiagnostics.measure('render'):
+                # the report returns its content, so the chunks are written
+                # to a file to only have the encoded document in memory
+                with tempfile.TemporaryFile() as file:
+                    for chunk in cls.stream(ids, html_data):
+                        file.write(chunk.encode('utf-8'))
+                    file.seek(0)
+                    content = file.read()
+            return 'html', content, action_report.direct_print, action_report.name
+        with MassBalanceDiagnostics.measure('render'):
+            return super().execute(ids, html_data)
+
+    @classmethod
+    def _html_data(cls, data, records, parameters):
+        "Return the data rendered by DominateReport for the report data"
+        return {
             'name': 'production.mass_balance.report',
             'model': data['model'],
             'records': records,
@@ -495,5 +3874,5 @@ function expand() {
             'output_format': 'html',
             'report_options': {
                 'now': datetime.now(),
-                }
-            })
\ No newline at end of file
+                },
+            }
\ No newline at end of file
@@ -0,0 +1,87 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from sql import Null
+
+from trytond.model import Index
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['Move']
+
+
+class Move(metaclass=PoolMeta):
+    __name__ = 'stock.move'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        # done moves of the productions searched by the mass balance
+        for column in [t.production_input, t.production_output]:
+            cls._sql_indexes.add(
+                Index(t,
+                    (t.product, Index.Equality()),
+                    (t.effective_date, Index.Range()),
+                    (column, Index.Equality()),
+                    where=(t.state == 'done') & (column != Null)))
+            if hasattr(cls, 'lot'):
+                cls._sql_indexes.add(
+                    Index(t,
+                        (t.lot, Index.Equality()),
+                        (t.effective_date, Index.Range()),
+                        (column, Index.Equality()),
+                        where=((t.state == 'done') & (column != Null)
+                            & (t.lot != Null))))
+
+    @classmethod
+    def create(cls, vlist):
+        moves = super().create(vlist)
+        cls._update_mass_balance_lines(moves)
+        return moves
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Production = pool.get('production')
+        moves = []
+        if Production.mass_balance_maintained():
+            actions = iter(args)
+            for records, values in zip(actions, actions):
+                if set(values) & cls._mass_balance_line_fields():
+                    moves.extend(records)
+        # moves may be moved out of their productions
+        productions = cls._mass_balance_productions(moves)
+        super().write(*args)
+        productions |= cls._mass_balance_productions(moves)
+        cls._update_mass_balance_lines(productions=productions)
+
+    @classmethod
+    def delete(cls, moves):
+        pool = Pool()
+        Production = pool.get('production')
+        productions = set()
+        if Production.mass_balance_maintained():
+            productions = cls._mass_balance_productions(moves)
+        super().delete(moves)
+        cls._update_mass_balance_lines(productions=productions)
+
+    @classmethod
+    def _mass_balance_line_fields(cls):
+        "Fields that change the mass balance ledger lines when written"
+        return {'state', 'product', 'quantity', 'unit', 'effective_date',
+            'lot', 'production_input', 'production_output'}
+
+    @classmethod
+    def _mass_balance_productions(cls, moves):
+        return {p.id for m in moves
+            for p in (m.production_input, m.production_output)
+            if p}
+
+    @classmethod
+    def _update_mass_balance_lines(cls, moves=None, productions=None):
+        pool = Pool()
+        Production = pool.get('production')
+        if not Production.mass_balance_maintained():
+            return
+        if productions is None:
+            productions = cls._mass_balance_productions(moves)
+        Production.queue_mass_balance_lines(list(productions))
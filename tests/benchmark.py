@@ -0,0 +1,350 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""
+Benchmark of the mass balance report
+
+It activates the module on the test database given by the DB_NAME and
+TRYTOND_DATABASE_URI environment variables, like the tests do, generates
+synthetic productions and measures the wall time, the number of SQL queries
+and the peak of memory of each phase of the report:
+
+    python -m trytond.modules.production_mass_balance_report.tests.benchmark \\
+        --productions 1000 --output result.json
+
+The result is stored as JSON and passing the result of a previous run with
+--compare shows the ratio of each measure and fails when one of them is
+slower than the threshold.
+"""
+import argparse
+import datetime
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from decimal import Decimal
+
+from trytond import backend
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.tests.test_tryton import DB_NAME, USER, activate_module
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.production_mass_balance_report.production import (
+    count_queries)
+
+MODULE = 'production_mass_balance_report'
+
+
+@contextmanager
+def measure(results, name):
+    "Store in results the time, queries and memory peak of the block"
+    counter = {'queries': 0}
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        with count_queries(counter):
+            yield
+    finally:
+        duration = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[name] = {
+            'time': duration,
+            'queries': counter['queries'],
+            'memory': peak,
+            }
+
+
+class Generator(object):
+    "Create the synthetic BOMs, productions, moves and lots"
+
+    def __init__(self, productions=100, components=5, boms=2, lots=10,
+            seed=0):
+        self.productions = productions
+        self.components = components
+        self.boms = boms
+        self.lots = lots
+        self.random = random.Random(seed)
+
+    def uoms(self):
+        "Return the default UoM and another UoM of its category to mix"
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        pairs = []
+        for default, other in [
+                ('Unit', 'Unit'),
+                ('Kilogram', 'Gram'),
+                ('Meter', 'Centimeter'),
+                ('Liter', 'Cubic centimeter'),
+                ]:
+            default_uoms = Uom.search([('name', '=', default)], limit=1)
+            other_uoms = Uom.search([('name', '=', other)], limit=1)
+            if default_uoms and other_uoms:
+                pairs.append((default_uoms[0], other_uoms[0]))
+        return pairs
+
+    def create_product(self, name, uom, producible=False):
+        pool = Pool()
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        template, = Template.create([{
+                    'name': name,
+                    'default_uom': uom.id,
+                    'type': 'goods',
+                    'producible': producible,
+                    'list_price': Decimal(10),
+                    }])
+        product, = Product.create([{
+                    'template': template.id,
+                    'cost_price': Decimal(1),
+                    }])
+        return product
+
+    def create(self):
+        "Return the product and the components of the productions"
+        pool = Pool()
+        BOM = pool.get('production.bom')
+        Location = pool.get('stock.location')
+        Production = pool.get('production')
+        try:
+            Lot = pool.get('stock.lot')
+        except KeyError:
+            Lot = None
+
+        uoms = self.uoms()
+        unit = uoms[0][0]
+        product = self.create_product('Benchmark Product', unit,
+            producible=True)
+        components = []
+        for n in range(self.components):
+            default, other = uoms[n % len(uoms)]
+            components.append((self.create_product(
+                        'Benchmark Component %s' % n, default), other))
+
+        boms = BOM.create([{
+                    'name': 'Benchmark BOM %s' % n,
+                    'inputs': [('create', [{
+                                    'product': component.id,
+                                    'unit': other.id,
+                                    'quantity': self.random.randint(1, 100),
+                                    } for component, other in components])],
+                    'outputs': [('create', [{
+                                    'product': product.id,
+                                    'unit': unit.id,
+                                    'quantity': 1,
+                                    }])],
+                    } for n in range(self.boms)])
+
+        lots = []
+        component_lots = {}
+        if Lot and self.lots:
+            lots = Lot.create([{
+                        'number': 'BENCH-%s' % n,
+                        'product': product.id,
+                        } for n in range(self.lots)])
+            component_lots = {c: Lot.create([{
+                            'number': 'BENCH-%s-%s' % (c.id, n),
+                            'product': c.id,
+                            } for n in range(self.lots)])
+                for c, _ in components}
+
+        storage, = Location.search([('code', '=', 'STO')])
+        location, = Location.search([('type', '=', 'production')], limit=1)
+        warehouse, = Location.search([('type', '=', 'warehouse')], limit=1)
+        company_id = Transaction().context['company']
+        company = pool.get('company.company')(company_id)
+        today = datetime.date.today()
+
+        def move(product, uom, quantity, from_location, to_location, date,
+                lots):
+            values = {
+                'product': product.id,
+                'unit': uom.id,
+                'quantity': quantity,
+                'from_location': from_location.id,
+                'to_location': to_location.id,
+                'effective_date': date,
+                'state': 'done',
+                'company': company_id,
+                'unit_price': Decimal(1),
+                'currency': company.currency.id,
+                }
+            if lots:
+                values['lot'] = self.random.choice(lots).id
+            return values
+
+        values = []
+        for n in range(self.productions):
+            bom = self.random.choice(boms)
+            quantity = self.random.randint(1, 20)
+            date = today - datetime.timedelta(days=self.random.randint(0,
+                        365))
+            values.append({
+                    'product': product.id,
+                    'bom': bom.id,
+                    'unit': unit.id,
+                    'quantity': quantity,
+                    'warehouse': warehouse.id,
+                    'location': location.id,
+                    'company': company_id,
+                    'effective_date': date,
+                    'effective_start_date': date,
+                    'state': 'done',
+                    'inputs': [('create', [move(component, other,
+                                    quantity * self.random.uniform(50, 150),
+                                    storage, location, date,
+                                    component_lots.get(component))
+                                for component, other in components])],
+                    'outputs': [('create', [move(product, unit, quantity,
+                                    location, storage, date, lots)])],
+                    })
+            if len(values) >= 100:
+                Production.create(values)
+                values = []
+        if values:
+            Production.create(values)
+        return product, [c for c, _ in components], lots
+
+
+def explain(query):
+    "Return the lines of the plan of the query on the database"
+    cursor = Transaction().connection.cursor()
+    if backend.name == 'sqlite':
+        command = 'EXPLAIN QUERY PLAN '
+    else:
+        command = 'EXPLAIN '
+    cursor.execute(command + str(query), query.params)
+    return [' '.join(str(c) for c in line) for line in cursor]
+
+
+def run_report(results, prefix, data):
+    "Measure the phases of the report for data"
+    pool = Pool()
+    Production = pool.get('production')
+    Report = pool.get('production.mass_balance.report', type='report')
+
+    requested_product = pool.get('product.product')(data['product'])
+    lot = pool.get('stock.lot')(data['lot']) if data.get('lot') else None
+    requests = [(requested_product, lot)]
+
+    results[prefix + 'plan'] = explain(Production._mass_balance_lookup_query(
+            requests, data['direction']))
+    with measure(results, prefix + 'mass_balance_lookup'):
+        productions = list(Production.mass_balance_lookup(
+                requests, data['direction'])[(requested_product, lot)])
+    with measure(results, prefix + 'mass_balance_report_data'):
+        for production in productions:
+            production.mass_balance_report_data(requested_product,
+                data['direction'], lot)
+    with measure(results, prefix + 'mass_balance_report_data_sql'):
+        Production.mass_balance_report_data_sql(productions,
+            requested_product, data['direction'], lot)
+    for engine in ['orm', 'sql']:
+        with measure(results, prefix + 'prepare_' + engine):
+            records, parameters = Report.prepare(dict(data, engine=engine))
+    with measure(results, prefix + 'body'):
+        Report.body(None, {
+                'records': records,
+                'parameters': parameters,
+                }, records).render()
+    results[prefix + 'productions'] = len(productions)
+
+
+def benchmark(options):
+    "Return the results of the benchmark"
+    if not config.has_section('production_mass_balance'):
+        config.add_section('production_mass_balance')
+    # Measure the computation instead of the result cache
+    config.set('production_mass_balance', 'cache_size', '0')
+
+    activate_module([MODULE, 'stock_lot'])
+    results = {}
+    with Transaction().start(DB_NAME, USER, context={}) as transaction:
+        company = create_company()
+        with set_company(company):
+            generator = Generator(productions=options.productions,
+                components=options.components, boms=options.boms,
+                lots=options.lots, seed=options.seed)
+            with measure(results, 'generate'):
+                product, components, lots = generator.create()
+            cases = [
+                ('backward', product, None),
+                ('forward', components[0], None),
+                ]
+            if lots:
+                cases.append(('backward', product, lots[0]))
+            for direction, requested_product, lot in cases:
+                prefix = '%s/%s/' % (direction, 'lot' if lot else 'product')
+                run_report(results, prefix, {
+                        'direction': direction,
+                        'product': requested_product.id,
+                        'lot': lot.id if lot else None,
+                        'depth': 1,
+                        'model': None,
+                        'ids': [],
+                        })
+        transaction.rollback()
+    return {
+        'date': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'backend': backend.name,
+        'options': vars(options),
+        'results': results,
+        }
+
+
+def compare(current, previous, threshold):
+    "Print the ratio of the measures and return the regressions"
+    regressions = []
+    for phase, values in sorted(current['results'].items()):
+        before = previous['results'].get(phase)
+        if phase.endswith('plan') and before and values != before:
+            print('%s changed from\n    %s\nto\n    %s' % (phase,
+                    '\n    '.join(before), '\n    '.join(values)))
+        if not isinstance(values, dict) or not isinstance(before, dict):
+            continue
+        ratios = []
+        for name in ['time', 'queries', 'memory']:
+            ratio = values[name] / before[name] if before[name] else 1.0
+            ratios.append('%s x%.2f' % (name, ratio))
+            if ratio > threshold:
+                regressions.append((phase, name, ratio))
+        print('%-50s %s' % (phase, ', '.join(ratios)))
+    return regressions
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--productions', type=int, default=100)
+    parser.add_argument('--components', type=int, default=5)
+    parser.add_argument('--boms', type=int, default=2)
+    parser.add_argument('--lots', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file to store the result')
+    parser.add_argument('--compare', help='result of a previous run')
+    parser.add_argument('--threshold', type=float, default=1.2,
+        help='maximum ratio allowed when comparing')
+    options = parser.parse_args(args)
+
+    result = benchmark(options)
+    for phase, values in sorted(result['results'].items()):
+        if phase.endswith('plan'):
+            print('%s\n    %s' % (phase, '\n    '.join(values)))
+        else:
+            print('%-50s %s' % (phase, values))
+    if options.output:
+        with open(options.output, 'w') as file:
+            json.dump(result, file, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as file:
+            previous = json.load(file)
+        if compare(result, previous, options.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
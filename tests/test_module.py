@@ -2,13 +2,54 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 import datetime
+import pickle
+from concurrent.futures import Future
+from types import SimpleNamespace
 from decimal import Decimal
 from dateutil.relativedelta import relativedelta
+from sql import Null
+from trytond import backend
+from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.model import Index
 from trytond.pool import Pool
+from trytond.protocols.dispatcher import get_object_method
 from trytond.transaction import Transaction
 from trytond.modules.company.tests import CompanyTestMixin
 from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.production_mass_balance_report import (
+    production as production_module)
+
+
+class PartitionExecutor(object):
+    """
+    Executor running the partitions in the transaction of the test, as the
+    worker processes do not see its uncommitted data
+    """
+    executors = []
+
+    def __init__(self, max_workers, mp_context, initializer, initargs):
+        self.max_workers = max_workers
+        self.mp_context = mp_context
+        self.partitions = []
+        # the arguments are sent to the spawned processes
+        pickle.dumps(initargs)
+        self.executors.append(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    def submit(self, fn, database_name, user, context, *args):
+        assert fn is production_module._compute_partition
+        pickle.dumps((database_name, user, context) + args)
+        self.partitions.append(args[0])
+        future = Future()
+        future.set_result(production_module._dump_partition(*args))
+        return future
 
 
 class ProductionMassBalanceReportTestCase(CompanyTestMixin, ModuleTestCase):
@@ -170,6 +211,13 @@ class ProductionMassBalanceReportTestCase(CompanyTestMixin, ModuleTestCase):
                 self.assertEqual(res[key]['balance_plan_consumption'], value[2])
                 self.assertEqual(res[key]['balance_difference'], value[3])
 
+            # The ledger of the next production is maintained
+            if not config.has_section('production_mass_balance'):
+                config.add_section('production_mass_balance')
+            config.set('production_mass_balance', 'ledger', 'True')
+            self.addCleanup(config.remove_option, 'production_mass_balance',
+                'ledger')
+
             # Make a production with effective date yesterday and running the day before
             Production = pool.get('production')
             production = Production()
@@ -195,6 +243,55 @@ class ProductionMassBalanceReportTestCase(CompanyTestMixin, ModuleTestCase):
             self.assertEqual(res[product]['balance_plan_consumption'], 10.0)
             self.assertEqual(res[product]['balance_difference'], 0.0)
 
+            # the former keys of the productions are still available
+            row, = res[product]['productions']
+            self.assertEqual(row['product'], product)
+            self.assertEqual(row['uom'], production.unit)
+            self.assertEqual(row['default_uom'], product.default_uom)
+            row['balance_difference'] = 1.0
+            self.assertEqual(res[product].rows[0].difference, 1.0)
+
+            # SQL engine gives the same result as the per production one
+            sql_res = Production.mass_balance_report_data_sql([production],
+                component1, direction='forward')[production]
+            for key in ['balance_quantity', 'balance_consumption',
+                    'balance_plan_consumption', 'balance_difference']:
+                self.assertEqual(sql_res[product][key], res[product][key])
+
+            # NumPy engine gives the same result as the SQL one
+            try:
+                import numpy
+            except ImportError:
+                numpy = None
+            if numpy is not None:
+                for requested_product, direction in [
+                        (component1, 'forward'), (product, 'backward')]:
+                    sql_res = Production.mass_balance_report_data_sql(
+                        [production], requested_product, direction)
+                    numpy_res = Production.mass_balance_report_data_numpy(
+                        [production], requested_product, direction)
+                    self.assertEqual(
+                        {k: v.dump() for k, v in numpy_res[production].items()},
+                        {k: v.dump() for k, v in sql_res[production].items()})
+
+            # The ledger is updated when the production is done
+            Line = pool.get('production.mass_balance.line')
+            Production.flush_mass_balance_lines()
+            lines = Line.search([
+                    ('production', '=', production.id),
+                    ('direction', '=', 'forward'),
+                    ('requested_product', '=', component1.id),
+                    ])
+            line, = lines
+            self.assertEqual(line.product, product)
+            self.assertEqual(line.quantity, 10.0)
+            self.assertEqual(line.plan_consumption, 10.0)
+            self.assertEqual(len(Line.search([
+                            ('production', '=', production.id),
+                            ('direction', '=', 'backward'),
+                            ])), 2)
+            config.set('production_mass_balance', 'ledger', 'False')
+
             PrintProductionMassBalanceReport = Pool().get('production.mass_balance.report', type='report')
             ProductionMassBalanceReport = Pool().get('production.print_mass_balance', type='wizard')
             # with Transaction().set_context(active_model='product.product', active_id=product.id):
@@ -206,8 +303,839 @@ class ProductionMassBalanceReportTestCase(CompanyTestMixin, ModuleTestCase):
                 print_general_ledger.start.from_date = None
                 print_general_ledger.start.to_date = None
                 print_general_ledger.start.lot = None
+                print_general_ledger.start.depth = 2
                 _, data = print_general_ledger.do_print_(None)
                 oext, content, _, _ = PrintProductionMassBalanceReport.execute(ids=[product.id], data=data)
                 self.assertEqual(oext, 'html')
 
+                # Export the summary and production rows to CSV
+                oext, content, _, _ = PrintProductionMassBalanceReport.execute(
+                    ids=[product.id], data=dict(data, output_format='csv'))
+                self.assertEqual(oext, 'csv')
+                header, *rows = content.decode('utf-8').splitlines()
+                self.assertTrue(header.startswith('requested_product,'))
+                self.assertEqual(len(rows), 2 + 2 * 2)
+
+                # Large reports are streamed as the same document
+                records, parameters = PrintProductionMassBalanceReport.prepare(
+                    data)
+                html_data = PrintProductionMassBalanceReport._html_data(data,
+                    records, parameters)
+                streamed = ''.join(PrintProductionMassBalanceReport.stream(
+                        [product.id], html_data))
+                _, content, _, _ = super(
+                    production_module.PrintProductionMassBalanceReport,
+                    PrintProductionMassBalanceReport).execute(
+                        [product.id], html_data)
+                if isinstance(content, bytes):
+                    content = content.decode('utf-8')
+                self.assertEqual(streamed, content)
+                for record in records.values():
+                    for row in record.rows:
+                        self.assertIn(
+                            '/model/production/%s;' % row.id, streamed)
+
+                # Only the formats of the report can be exported
+                with self.assertRaises(UserError):
+                    PrintProductionMassBalanceReport.execute(
+                        ids=[product.id], data=dict(data, output_format='rows'))
+
+                # Diagnostics of the phases are added to the report
+                with Transaction().set_context(
+                        mass_balance_diagnostics='report'):
+                    _, content, _, _ = PrintProductionMassBalanceReport.execute(
+                        ids=[product.id], data=data)
+                if isinstance(content, bytes):
+                    content = content.decode('utf-8')
+                self.assertIn('id="diagnostics"', content)
+
+                # Trend mode sums the mass balance lines by period
+                with self.assertRaises(UserError):
+                    PrintProductionMassBalanceReport.prepare(
+                        dict(data, trend='month'))
+                config.set('production_mass_balance', 'ledger', 'True')
+                try:
+                    records, parameters = (
+                        PrintProductionMassBalanceReport.prepare(
+                            dict(data, trend='month')))
+                    _, weeks = PrintProductionMassBalanceReport.prepare(
+                        dict(data, trend='week'))
+                    # the trend is only computed for the product
+                    with self.assertRaises(UserError):
+                        PrintProductionMassBalanceReport.prepare(
+                            dict(data, trend='month',
+                                products=[component1.id]))
+                finally:
+                    config.set('production_mass_balance', 'ledger', 'False')
+                for _, _, periods in weeks['trend']:
+                    self.assertEqual(
+                        {p.weekday() for p, _, _, _ in periods}, {0})
+                self.assertEqual(records, {})
+                self.assertEqual(
+                    {p for p, _, _ in parameters['trend']},
+                    {component1, component2})
+                for component, _, periods in parameters['trend']:
+                    lines = Line.search([
+                            ('direction', '=', 'backward'),
+                            ('requested_product', '=', product.id),
+                            ('product', '=', component.id),
+                            ])
+                    self.assertEqual(
+                        sum(c for _, c, _, _ in periods),
+                        sum(l.consumption for l in lines))
+
+                # Computing by chunks gives the same records
+                records, _ = PrintProductionMassBalanceReport.prepare(
+                    dict(data, engine='orm'))
+                if not config.has_section('production_mass_balance'):
+                    config.add_section('production_mass_balance')
+                config.set('production_mass_balance', 'chunk_size', '1')
+                try:
+                    chunked, _ = PrintProductionMassBalanceReport.prepare(
+                        dict(data, engine='orm', depth=1))
+                finally:
+                    config.remove_option('production_mass_balance',
+                        'chunk_size')
+                self.assertEqual(
+                    {k: v.dump() for k, v in chunked.items()},
+                    {k: v.dump() for k, v in records.items()})
+
+                # Sliding windows are combined from the results of each day
+                window = dict(data, depth=1, from_date=before_yesterday,
+                    to_date=today)
+                config.set('production_mass_balance', 'cache_size', '0')
+                try:
+                    records, _ = PrintProductionMassBalanceReport.prepare(
+                        window)
+                    config.set('production_mass_balance', 'incremental',
+                        'True')
+                    for _ in range(2):
+                        incremental, _ = (
+                            PrintProductionMassBalanceReport.prepare(window))
+                        self.assertEqual(
+                            {k: v.dump() for k, v in incremental.items()},
+                            {k: v.dump() for k, v in records.items()})
+                    Day = pool.get('production.mass_balance.day')
+                    self.assertEqual(
+                        sorted(d.date for d in Day.search([])),
+                        [yesterday, today])
+                finally:
+                    config.remove_option('production_mass_balance',
+                        'cache_size')
+                    config.remove_option('production_mass_balance',
+                        'incremental')
+
+                # Only the production with the largest deviation is kept
+                records, _ = PrintProductionMassBalanceReport.prepare(data)
+                limited, _ = PrintProductionMassBalanceReport.prepare(
+                    dict(data, deviation_limit=1))
+                self.assertEqual(list(limited), list(records))
+                for key, record in limited.items():
+                    self.assertEqual(len(record.rows), 1)
+                    self.assertEqual(record.consumption,
+                        records[key].consumption)
+
+                # The results are returned as data by pages
+                result = PrintProductionMassBalanceReport.get_data(data,
+                    fields=['summary', 'consumption'])
+                self.assertNotIn('details', result)
+                self.assertEqual(
+                    {v['product'] for v in result['summary']
+                        if v['level'] == 1},
+                    {component1.id, component2.id})
+                self.assertEqual(set(result['summary'][0]), {
+                        'requested_product', 'lot', 'level', 'product',
+                        'quantity_uom', 'uom', 'consumption'})
+                details, after = [], None
+                while True:
+                    result = PrintProductionMassBalanceReport.get_data(data,
+                        fields=['details'], product=component1.id,
+                        after=after, limit=1)
+                    details.extend(result['details'])
+                    after = result['next']
+                    if not after:
+                        break
+                self.assertEqual(len(details), 2)
+                self.assertLess(details[0]['production'],
+                    details[1]['production'])
+
+                # get_data is called on RPC like the dispatcher does
+                obj, method = get_object_method(SimpleNamespace(
+                        rpc_method='report.%s.get_data'
+                        % PrintProductionMassBalanceReport.__name__), pool)
+                self.assertEqual(method, 'get_data')
+                self.assertNotIn('get_details', obj.__rpc__)
+                rpc = obj.__rpc__[method]
+                args, kwargs, context, _ = rpc.convert(obj, data,
+                    ['summary'], dict(Transaction().context))
+                with Transaction().set_context(context):
+                    result = rpc.result(
+                        rpc.decorate(getattr(obj, method))(*args, **kwargs))
+                self.assertEqual(result,
+                    PrintProductionMassBalanceReport.get_data(data,
+                        ['summary']))
+
+                # Batch mode computes a section for each product
+                records, parameters = PrintProductionMassBalanceReport.prepare({
+                        'direction': 'forward',
+                        'product': component1.id,
+                        'products': [component2.id],
+                        'depth': 1,
+                        })
+                self.assertEqual(records, {})
+                self.assertEqual(
+                    [(p, l) for p, l, _ in parameters['sections']],
+                    [(component1, None), (component2, None)])
+                for _, _, section in parameters['sections']:
+                    self.assertEqual(list(section), [product])
+
+                # Next runs are served from the result cache when enabled
+                config.set('production_mass_balance', 'cache_size', '100')
+                self.addCleanup(config.remove_option,
+                    'production_mass_balance', 'cache_size')
+                Cache = pool.get('production.mass_balance.cache')
+                cache_table = Cache.__table__()
+                cursor = Transaction().connection.cursor()
+
+                def hits():
+                    cursor.execute(*cache_table.select(cache_table.hits,
+                            where=cache_table.key == Cache.get_key(
+                                data, company.id)))
+                    return cursor.fetchone()[0]
+
+                records, _ = PrintProductionMassBalanceReport.prepare(data)
+                before = hits()
+                cached, _ = PrintProductionMassBalanceReport.prepare(data)
+                self.assertEqual(hits(), before + 1)
+                self.assertEqual(list(cached), list(records))
+                self.assertEqual(
+                    [v['balance_consumption'] for v in cached.values()],
+                    [v['balance_consumption'] for v in records.values()])
+
+                # The most requested reports are precomputed for the usual
+                # ranges of dates
+                self.assertIn((company.id, product.id, 'backward'),
+                    Cache._precompute_requests())
+                Cache.precompute()
+                Date = pool.get('ir.date')
+                for from_date, to_date in Cache._precompute_dates(
+                        Date.today()):
+                    request = dict(data, depth=1, from_date=from_date,
+                        to_date=to_date)
+                    cache, = Cache.search([
+                            ('key', '=', Cache.get_key(request, company.id)),
+                            ])
+                    self.assertTrue(cache.precomputed)
+                    self.assertEqual(cache.hits, 0)
+
+            # The lots of the productions are stored for lot reports
+            Lot = pool.get('stock.lot')
+            MassBalanceLot = pool.get('production.mass_balance.lot')
+            Move = pool.get('stock.move')
+            lot = Lot(number='1', product=product)
+            lot.save()
+            output, = production.outputs
+            move = Move.__table__()
+            cursor.execute(*move.update([move.lot], [lot.id],
+                    where=move.id == output.id))
+            Production.update_mass_balance_lots([production])
+            lot_line, = MassBalanceLot.search([
+                    ('production', '=', production.id),
+                    ])
+            self.assertEqual(lot_line.type, 'output')
+            self.assertEqual(lot_line.lot, lot)
+            self.assertEqual(lot_line.quantity, 2.0)
+            self.assertEqual(MassBalanceLot.trace([lot], 'backward'),
+                {1: []})
+            request = (product, lot)
+            expected = Production.mass_balance_lookup([request], 'backward')
+            config.set('production_mass_balance', 'lots', 'True')
+            try:
+                found = Production.mass_balance_lookup([request], 'backward')
+            finally:
+                config.remove_option('production_mass_balance', 'lots')
+            self.assertEqual(list(found[request]), [production])
+            self.assertEqual(found, expected)
+
+    def _create_product(self, name, producible=False):
+        "Create a product in units"
+        pool = Pool()
+        ProductUom = pool.get('product.uom')
+        ProductTemplate = pool.get('product.template')
+        Product = pool.get('product.product')
+        unit, = ProductUom.search([('name', '=', 'Unit')])
+        template = ProductTemplate()
+        template.name = name
+        template.default_uom = unit
+        template.type = 'goods'
+        template.producible = producible
+        template.list_price = Decimal(10)
+        template.save()
+        product = Product(template=template)
+        product.cost_price = Decimal(5)
+        product.save()
+        return product
+
+    def _create_bom(self, input_product, input_quantity, output_product):
+        "Create a BOM of one output from the quantity of one input"
+        pool = Pool()
+        BOM = pool.get('production.bom')
+        BOMInput = pool.get('production.bom.input')
+        BOMOutput = pool.get('production.bom.output')
+        bom = BOM(name=output_product.rec_name)
+        bom.save()
+        input_ = BOMInput(bom=bom)
+        input_.product = input_product
+        input_.on_change_product()
+        input_.quantity = input_quantity
+        input_.save()
+        output = BOMOutput(bom=bom)
+        output.product = output_product
+        output.on_change_product()
+        output.quantity = 1
+        output.save()
+        return bom
+
+    def _do_production(self, product, bom, quantity, date, lots=None):
+        "Create and do a production on date with the lot of each product"
+        pool = Pool()
+        Production = pool.get('production')
+        Move = pool.get('stock.move')
+        production = Production()
+        production.planned_date = date
+        production.effective_start_date = date
+        production.effective_date = date
+        production.product = product
+        production.on_change_product()
+        production.bom = bom
+        production.quantity = quantity
+        production.on_change_quantity()
+        production.save()
+        Production.wait([production])
+        moves = list(production.inputs) + list(production.outputs)
+        for move in moves:
+            move.lot = (lots or {}).get(move.product)
+        Move.save(moves)
+        Production.assign([production])
+        Production.run([production])
+        Production.do([production])
+        return production
+
+    def _create_chain(self):
+        """
+        Create a production of intermediate from base done yesterday and a
+        production of final from intermediate done today with a lot on each
+        of their moves
+        """
+        pool = Pool()
+        Lot = pool.get('stock.lot')
+        today = datetime.date.today()
+        yesterday = today - relativedelta(days=1)
+
+        base = self._create_product('base')
+        intermediate = self._create_product('intermediate', producible=True)
+        final = self._create_product('final', producible=True)
+        lots = {}
+        for product in [base, intermediate, final]:
+            lots[product] = Lot(number=product.rec_name, product=product)
+        Lot.save(list(lots.values()))
+        first = self._do_production(intermediate,
+            self._create_bom(base, 2, intermediate), 2, yesterday, lots)
+        second = self._do_production(final,
+            self._create_bom(intermediate, 1, final), 2, today, lots)
+        return (base, intermediate, final), lots, (first, second)
+
+    @with_transaction()
+    def test_mass_balance_levels(self):
+        'Test the mass balance of each level of the genealogy'
+        pool = Pool()
+        Production = pool.get('production')
+        Report = pool.get('production.mass_balance.report', type='report')
+
+        company = create_company()
+        with set_company(company):
+            (base, intermediate, final), lots, (first, second) = (
+                self._create_chain())
+
+            tree = Production.mass_balance_genealogy(final, 'backward',
+                depth=2)
+            self.assertEqual(dict(tree), {
+                    1: [(second.id, final.id, lots[final].id)],
+                    2: [(first.id, intermediate.id, lots[intermediate].id)],
+                    })
+
+            data = {
+                'product': final.id,
+                'direction': 'backward',
+                'depth': 2,
+                }
+            for engine in ['sql', 'orm']:
+                records, parameters = Report.prepare(
+                    dict(data, engine=engine))
+                self.assertEqual(list(records), [intermediate])
+                record = records[intermediate]
+                self.assertEqual(record.consumption, 2.0)
+                self.assertEqual(record.plan_consumption, 2.0)
+                self.assertEqual([r.id for r in record.rows], [second.id])
+                levels = dict(parameters['levels'])
+                self.assertEqual(list(levels), [2])
+                self.assertEqual(list(levels[2]), [base])
+                record = levels[2][base]
+                self.assertEqual(record.consumption, 4.0)
+                self.assertEqual(record.plan_consumption, 4.0)
+                self.assertEqual(record.difference, 0.0)
+                self.assertEqual([r.id for r in record.rows], [first.id])
+
+            # the levels use the engine of the report
+            called = []
+            mass_balance_results = Production.mass_balance_results.__func__
+
+            def results(cls, productions, *args, engine=None, **kwargs):
+                called.append(engine)
+                return mass_balance_results(cls, productions, *args,
+                    engine=engine, **kwargs)
+            Production.mass_balance_results = classmethod(results)
+            try:
+                Report.prepare(dict(data, engine='orm'))
+            finally:
+                del Production.mass_balance_results
+            self.assertEqual(set(called), {'orm'})
+
+    @with_transaction()
+    def test_mass_balance_ledger(self):
+        'Test the mass balance ledger follows the BOMs and the moves'
+        pool = Pool()
+        Production = pool.get('production')
+        Line = pool.get('production.mass_balance.line')
+        BOMInput = pool.get('production.bom.input')
+        Report = pool.get('production.mass_balance.report', type='report')
+        cursor = Transaction().connection.cursor()
+        yesterday = datetime.date.today() - relativedelta(days=1)
+
+        if not config.has_section('production_mass_balance'):
+            config.add_section('production_mass_balance')
+        config.set('production_mass_balance', 'ledger', 'True')
+        self.addCleanup(config.remove_option, 'production_mass_balance',
+            'ledger')
+
+        company = create_company()
+        with set_company(company):
+            (base, intermediate, _), _, (first, _) = self._create_chain()
+            Production.flush_mass_balance_lines()
+            line, = Line.search([
+                    ('production', '=', first.id),
+                    ('direction', '=', 'backward'),
+                    ])
+            self.assertEqual(line.plan_consumption, 4.0)
+
+            # changing the BOM recomputes the lines of its productions
+            input_, = first.bom.inputs
+            BOMInput.write([input_], {'quantity': 3})
+            Production.flush_mass_balance_lines()
+            line, = Line.search([
+                    ('production', '=', first.id),
+                    ('direction', '=', 'backward'),
+                    ])
+            self.assertEqual(line.plan_consumption, 6.0)
+            self.assertEqual(line.difference, -2.0)
+
+            # the productions are found from their moves, not the line date
+            table = Line.__table__()
+            cursor.execute(*table.update([table.date],
+                    [yesterday - relativedelta(days=10)],
+                    where=table.production == first.id))
+            records, _ = Report.prepare({
+                    'product': intermediate.id,
+                    'direction': 'backward',
+                    'from_date': yesterday,
+                    'to_date': yesterday,
+                    })
+            self.assertEqual(list(records), [base])
+            self.assertEqual(records[base].plan_consumption, 6.0)
+
+    @with_transaction()
+    def test_mass_balance_run(self):
+        'Test the mass balance computed in the queue'
+        pool = Pool()
+        Run = pool.get('production.mass_balance.run')
+        Queue = pool.get('ir.queue')
+        Attachment = pool.get('ir.attachment')
+        Report = pool.get('production.mass_balance.report', type='report')
+        Wizard = pool.get('production.print_mass_balance', type='wizard')
+
+        company = create_company()
+        with set_company(company):
+            _, _, final = self._create_chain()[0]
+
+            # the wizard enqueues a run
+            session_id, _, _ = Wizard.create()
+            wizard = Wizard(session_id)
+            wizard.start.product = final
+            wizard.start.products = []
+            wizard.start.direction = 'backward'
+            wizard.start.from_date = None
+            wizard.start.to_date = None
+            wizard.start.depth = 1
+            wizard.start.output_format = 'csv'
+            wizard.start.trend = None
+            wizard.start.deviation_limit = None
+            wizard.start.deviation_threshold = None
+            wizard.start.deviation_percentage = False
+            wizard.start.lot = None
+            wizard.start.lots = []
+            wizard.start.asynchronous = True
+            self.assertEqual(wizard.transition_choose(), 'enqueue')
+            self.assertEqual(wizard.transition_enqueue(), 'end')
+            run, = Run.search([])
+            self.assertEqual(run.state, 'queued')
+            task, = [t for t in Queue.search([])
+                if t.data['model'] == Run.__name__]
+            self.assertEqual(task.data['method'], 'process')
+            self.assertEqual(task.data['instances'], [run.id])
+
+            # processing the run attaches the report to it
+            Run.process([run])
+            run = Run(run.id)
+            self.assertEqual(run.state, 'done')
+            self.assertEqual(run.progress, 1.0)
+            attachment, = Attachment.search([
+                    ('resource', '=', str(run)),
+                    ])
+            self.assertTrue(attachment.name.endswith('.csv'))
+
+            # a failure is stored in its own transaction
+            failed = []
+
+            def set_failed(cls, run_id, error, rec_name, user_id):
+                failed.append((run_id, error))
+
+            def execute(cls, ids, data):
+                raise ValueError('broken')
+            Run.set_failed = classmethod(set_failed)
+            self.addCleanup(delattr, Run, 'set_failed')
+            Report.execute = classmethod(execute)
+            self.addCleanup(delattr, Report, 'execute')
+            run = Run.create_from_data(wizard.get_report_data())
+            Run.process([run])
+            self.assertEqual(failed, [(run.id, 'broken')])
+
+            # the queue retries the runs on operational errors
+            def execute(cls, ids, data):
+                raise backend.DatabaseOperationalError
+            Report.execute = classmethod(execute)
+            with self.assertRaises(backend.DatabaseOperationalError):
+                Run.process([run])
+
+    @with_transaction()
+    def test_mass_balance_precompute(self):
+        'Test the reports served from the precomputed results'
+        pool = Pool()
+        Cron = pool.get('ir.cron')
+        ModelData = pool.get('ir.model.data')
+        Cache = pool.get('production.mass_balance.cache')
+        Report = pool.get('production.mass_balance.report', type='report')
+        Wizard = pool.get('production.print_mass_balance', type='wizard')
+
+        if not config.has_section('production_mass_balance'):
+            config.add_section('production_mass_balance')
+        for name, value in [
+                ('cache_size', '100'),
+                ('precompute_products', 'FINAL'),
+                ('precompute_limit', '0'),
+                ]:
+            config.set('production_mass_balance', name, value)
+            self.addCleanup(config.remove_option, 'production_mass_balance',
+                name)
+
+        company = create_company()
+        with set_company(company):
+            (_, intermediate, final), _, (_, second) = self._create_chain()
+            final.code = 'FINAL'
+            final.save()
+
+            cron = Cron(ModelData.get_id('production_mass_balance_report',
+                    'cron_precompute_mass_balance'))
+            Cron.run_once([cron])
+            caches = Cache.search([])
+            self.assertEqual(len(caches), 3)
+            self.assertTrue(all(c.precomputed for c in caches))
+            self.assertTrue(all(c.product == final for c in caches))
+            self.assertEqual({c.hits for c in caches}, {0})
+
+            today = datetime.date.today()
+            session_id, _, _ = Wizard.create()
+            wizard = Wizard(session_id)
+            wizard.start.product = final
+            wizard.start.products = []
+            wizard.start.direction = 'backward'
+            wizard.start.from_date = today.replace(month=1, day=1)
+            wizard.start.to_date = today
+            wizard.start.depth = 1
+            wizard.start.output_format = 'html'
+            wizard.start.trend = None
+            wizard.start.deviation_limit = None
+            wizard.start.deviation_threshold = None
+            wizard.start.deviation_percentage = False
+            wizard.start.lot = None
+            wizard.start.lots = []
+            wizard.start.asynchronous = False
+            _, data = wizard.do_print_(None)
+
+            # the report is not computed again
+            def compute_results(cls, *args):
+                raise AssertionError('computed')
+            Report._compute_results = classmethod(compute_results)
+            self.addCleanup(delattr, Report, '_compute_results')
+            records, _ = Report.prepare(data)
+            self.assertEqual([r.id for r in records[intermediate].rows],
+                [second.id])
+            cache, = Cache.search([
+                    ('from_date', '=', today.replace(month=1, day=1)),
+                    ('to_date', '=', today),
+                    ])
+            self.assertEqual(cache.hits, 1)
+            self.assertLessEqual(cache.last_access, datetime.datetime.now())
+
+    @with_transaction()
+    def test_mass_balance_lots(self):
+        'Test the mass balance of the chain of lots'
+        pool = Pool()
+        Production = pool.get('production')
+        Lot = pool.get('stock.lot')
+        MassBalanceLot = pool.get('production.mass_balance.lot')
+        Queue = pool.get('ir.queue')
+        Report = pool.get('production.mass_balance.report', type='report')
+
+        if not config.has_section('production_mass_balance'):
+            config.add_section('production_mass_balance')
+        config.set('production_mass_balance', 'lots', 'True')
+        self.addCleanup(config.remove_option, 'production_mass_balance',
+            'lots')
+
+        company = create_company()
+        with set_company(company):
+            (base, intermediate, final), lots, (first, second) = (
+                self._create_chain())
+            # a production of final from the same lot of intermediate
+            other_lot = Lot(number='other', product=final)
+            other_lot.save()
+            other_lots = dict(lots)
+            other_lots[final] = other_lot
+            other = self._do_production(final,
+                self._create_bom(intermediate, 1, final), 1,
+                datetime.date.today(), other_lots)
+            Production.flush_mass_balance_lines()
+
+            backward = {
+                1: [(second.id, lots[intermediate].id)],
+                2: [(first.id, lots[base].id)],
+                }
+            forward = {
+                1: [(first.id, lots[intermediate].id)],
+                2: [(second.id, lots[final].id), (other.id, other_lot.id)],
+                }
+            self.assertEqual(dict(MassBalanceLot.trace(
+                        [lots[final]], 'backward', depth=2)), backward)
+            self.assertEqual(dict(MassBalanceLot.trace(
+                        [lots[base]], 'forward', depth=2)), forward)
+
+            # the report of a lot only has the productions of the lot
+            data = {
+                'product': final.id,
+                'direction': 'backward',
+                'engine': 'orm',
+                }
+            records, _ = Report.prepare(data)
+            self.assertEqual([r.id for r in records[intermediate].rows],
+                [second.id, other.id])
+            records, _ = Report.prepare(dict(data, lot=lots[final].id))
+            self.assertEqual([r.id for r in records[intermediate].rows],
+                [second.id])
+            _, parameters = Report.prepare(dict(data,
+                    lots=[lots[final].id, other_lot.id]))
+            self.assertEqual(
+                [(p, l, [r.id for r in s[intermediate].rows])
+                    for p, l, s in parameters['sections']],
+                [(final, None, [second.id, other.id]),
+                    (final, lots[final], [second.id]),
+                    (final, other_lot, [other.id])])
+
+            # the lots of the existing productions are filled by the queue
+            MassBalanceLot.delete(MassBalanceLot.search([]))
+            MassBalanceLot.fill(batch_size=2)
+            tasks = [t for t in Queue.search([], order=[('id', 'ASC')])
+                if t.data['method'] == 'update_mass_balance_lots']
+            self.assertEqual(
+                [t.data['instances'] for t in tasks],
+                [sorted([first.id, second.id]), [other.id]])
+            for task in tasks:
+                task.run()
+            self.assertEqual(dict(MassBalanceLot.trace(
+                        [lots[final]], 'backward', depth=2)), backward)
+            self.assertEqual(dict(MassBalanceLot.trace(
+                        [lots[base]], 'forward', depth=2)), forward)
+
+    @with_transaction()
+    def test_move_indexes(self):
+        'Test the indexes of the done moves of the productions'
+        pool = Pool()
+        Move = pool.get('stock.move')
+        table = Move.__table_handler__()
+        t = Move.__table__()
+
+        for column in [t.production_input, t.production_output]:
+            for indexed, where in [
+                    (t.product, (t.state == 'done') & (column != Null)),
+                    (t.lot, ((t.state == 'done') & (column != Null)
+                            & (t.lot != Null))),
+                    ]:
+                index = Index(t,
+                    (indexed, Index.Equality()),
+                    (t.effective_date, Index.Range()),
+                    (column, Index.Equality()),
+                    where=where)
+                self.assertIn(index, Move._sql_indexes)
+                name, _, params = table.index_translator_for(
+                    index).definition(index)
+                if params and backend.name == 'sqlite':
+                    # SQLite does not create the indexes with parameters
+                    continue
+                name = 'idx_' + table.convert_name(
+                    '_'.join([table.table_name, name]), reserved=len('idx_'))
+                self.assertIn(name, table._indexes)
+
+    @with_transaction()
+    def test_mass_balance_legacy(self):
+        'Test the overrides using the dictionaries formerly returned'
+        pool = Pool()
+        Production = pool.get('production')
+        Report = pool.get('production.mass_balance.report', type='report')
+
+        company = create_company()
+        with set_company(company):
+            (base, intermediate, final), lots, (first, second) = (
+                self._create_chain())
+
+            mass_balance_report_data = Production.mass_balance_report_data
+
+            def add_row(self, requested_product, direction, lot=None,
+                    cache=None):
+                res = mass_balance_report_data(self, requested_product,
+                    direction, lot=lot, cache=cache)
+                for product, record in res.items():
+                    record.setdefault('productions', []).append({
+                            'id': first.id,
+                            'name': 'extra',
+                            'balance_consumption': 1.0,
+                            })
+                    record['balance_consumption'] += 1.0
+                return res
+            Production.mass_balance_report_data = add_row
+            self.addCleanup(delattr, Production, 'mass_balance_report_data')
+
+            res = second.mass_balance_report_data(final, 'backward')
+            record = res[intermediate]
+            self.assertIn('productions', record)
+            self.assertNotIn('rows', record)
+            self.assertEqual(dict(record.items())['balance_consumption'], 3.0)
+            rows = record['productions']
+            self.assertEqual(len(rows), 2)
+            self.assertEqual(rows[-1]['name'], 'extra')
+            self.assertEqual(rows[-1]['default_uom'], intermediate.default_uom)
+            self.assertEqual(
+                [r['id'] for r in rows], [second.id, first.id])
+            self.assertEqual(record.rows[-1].consumption, 1.0)
+
+            records, _ = Report.prepare({
+                    'product': final.id,
+                    'direction': 'backward',
+                    'engine': 'orm',
+                    })
+            record = records[intermediate]
+            self.assertEqual(record.consumption, 3.0)
+            self.assertEqual([r.name for r in record.rows],
+                [second.rec_name, 'extra'])
+
+    @with_transaction()
+    def test_mass_balance_export(self):
+        'Test the export of the rows while the productions are computed'
+        pool = Pool()
+        Report = pool.get('production.mass_balance.report', type='report')
+
+        company = create_company()
+        with set_company(company):
+            (base, intermediate, final), lots, (_, second) = (
+                self._create_chain())
+            bom = self._create_bom(intermediate, 1, final)
+            self._do_production(final, bom, 3, datetime.date.today(), lots)
+
+            data = {
+                'product': final.id,
+                'direction': 'backward',
+                'engine': 'orm',
+                }
+            self.assertEqual(Report._export_engine(data), 'orm')
+            self.assertIsNone(Report._export_engine(dict(data, depth=2)))
+
+            records, parameters = Report.prepare(data)
+            oext, content = Report.export_computed(data, 'orm', 'csv')
+            self.assertEqual(oext, 'csv')
+            self.assertEqual(content,
+                Report.export(records, parameters, 'csv')[1])
+            header, *rows = content.decode('utf-8').splitlines()
+            # the rows of the productions are followed by the summary
+            self.assertEqual(len(rows), 2 + 1)
+            self.assertIn(second.rec_name, rows[0])
+            self.assertTrue(rows[-1].startswith(
+                    '%s,,1,%s,,' % (final.rec_name, intermediate.rec_name)))
+
+    @with_transaction()
+    def test_mass_balance_parallel(self):
+        'Test the mass balance computed by worker processes'
+        pool = Pool()
+        Report = pool.get('production.mass_balance.report', type='report')
+
+        company = create_company()
+        with set_company(company):
+            (base, intermediate, final), lots, _ = self._create_chain()
+            bom = self._create_bom(intermediate, 1, final)
+            productions = [
+                self._do_production(final, bom, quantity,
+                    datetime.date.today(), lots)
+                for quantity in [1, 3, 4]]
+
+            data = {
+                'product': final.id,
+                'direction': 'backward',
+                'engine': 'orm',
+                }
+            records, _ = Report.prepare(data)
+
+            self.addCleanup(setattr, production_module, 'ProcessPoolExecutor',
+                production_module.ProcessPoolExecutor)
+            production_module.ProcessPoolExecutor = PartitionExecutor
+            if not config.has_section('production_mass_balance'):
+                config.add_section('production_mass_balance')
+            config.set('production_mass_balance', 'workers', '2')
+            config.set('production_mass_balance', 'chunk_size', '1')
+            try:
+                parallel, _ = Report.prepare(data)
+            finally:
+                config.remove_option('production_mass_balance', 'workers')
+                config.remove_option('production_mass_balance', 'chunk_size')
+
+            executor, = PartitionExecutor.executors
+            del PartitionExecutor.executors[:]
+            self.assertEqual(executor.mp_context.get_start_method(), 'spawn')
+            self.assertEqual(executor.max_workers, 2)
+            self.assertEqual(len(executor.partitions), 2)
+            self.assertEqual(
+                sorted(i for p in executor.partitions for i in p),
+                sorted(r.id for r in records[intermediate].rows))
+            self.assertEqual(len(records[intermediate].rows),
+                len(productions) + 1)
+            self.assertEqual(
+                {k: v.dump() for k, v in parallel.items()},
+                {k: v.dump() for k, v in records.items()})
+
 del ModuleTestCase